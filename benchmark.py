@@ -0,0 +1,378 @@
+#!/usr/bin/python3
+
+# Copyright (c) 2021 Tuncay D.
+# MIT License, see LICENSE
+
+# Benchmark for each stage of the retroplay pipeline, run against generated
+# ROM trees, playlists and configs with a stub "retroarch" executable.  Every
+# file is created below the work directory and $HOME points there while the
+# benchmark runs, so the real caches and settings are never touched.
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import pathlib
+import platform
+import statistics
+import subprocess
+import importlib.util
+
+SYSTEMS = {
+    # core_id   (core file, extensions)
+    'nes':      ('mesen', ['nes', 'fds']),
+    'snes':     ('snes9x', ['sfc', 'smc']),
+    'gb':       ('sameboy', ['gb']),
+    'gbc':      ('sameboy', ['gbc']),
+    'gba':      ('mgba', ['gba']),
+    'md':       ('genesis_plus_gx', ['md', 'gen']),
+    'pce':      ('mednafen_pce', ['pce'])
+}
+FILES_PER_DIR = 500
+UNKNOWN_RATIO = 20
+CONFIG_LINES = 10000
+FILETYPE_RULES = 1000
+SEED = 1985
+STAGES = ['config', 'collect_dir', 'collect_index', 'collect_playlist',
+          'collect_playlist_cached', 'uniq', 'filter', 'sort', 'validate',
+          'resolve', 'menu', 'end_to_end']
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(
+        description=('Measure every stage of retroplay on generated data and'
+                     ' compare the results against an earlier run.'),
+        epilog=('Fixtures are generated once per size and reused in later'
+                ' runs of the same work directory.')
+    )
+
+    parser.add_argument(
+        '--sizes', '-s',
+        default='1000,10000,100000',
+        metavar='LIST',
+        help=('comma separated number of ROM files and playlist entries to'
+             ' generate and measure, such as "1000,10000,100000,1000000",'
+             ' defaults to "1000,10000,100000"')
+    )
+
+    parser.add_argument(
+        '--stages', '-t',
+        default=','.join(STAGES),
+        metavar='LIST',
+        help=('comma separated stages to measure, defaults to all: '
+             + ', '.join(STAGES))
+    )
+
+    parser.add_argument(
+        '--repeat', '-r',
+        default=3,
+        type=int,
+        metavar='NUM',
+        help='number of runs of each stage, the fastest one counts, defaults to 3'
+    )
+
+    parser.add_argument(
+        '--workdir', '-w',
+        default='/tmp/retroplay_benchmark',
+        metavar='DIR',
+        help=('directory for the generated files, defaults to'
+             ' "/tmp/retroplay_benchmark"')
+    )
+
+    parser.add_argument(
+        '--output', '-o',
+        metavar='FILE',
+        help='save the results as JSON to FILE'
+    )
+
+    parser.add_argument(
+        '--compare', '-c',
+        metavar='FILE',
+        help=('compare the results against a JSON file saved earlier with'
+             ' "--output" and exit with status 1 on any regression')
+    )
+
+    parser.add_argument(
+        '--threshold',
+        default=0.25,
+        type=float,
+        metavar='RATIO',
+        help=('a stage is a regression if it is slower than in the compared'
+             ' results by more than RATIO, defaults to 0.25 (25 percent)')
+    )
+
+    parser.add_argument(
+        '--min-delta',
+        default=0.005,
+        type=float,
+        metavar='SECONDS',
+        help=('ignore differences smaller than SECONDS, which are within the'
+             ' noise of a single run, defaults to 0.005')
+    )
+
+    return parser.parse_args()
+
+
+def get_retroplay(script_file):
+    spec = importlib.util.spec_from_file_location('retroplay', script_file)
+    retroplay = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(retroplay)
+    return retroplay
+
+
+def write_file(path, data):
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if isinstance(data, bytes):
+        path.write_bytes(data)
+    else:
+        path.write_text(data)
+
+
+def get_rom_names(size):
+    rand = random.Random(SEED)
+    words = ['Super', 'Mega', 'Dragon', 'Quest', 'Fighter', 'Kart', 'Star',
+             'Legend', 'World', 'Island', 'Racing', 'Soccer', 'Battle']
+    regions = ['(USA)', '(Europe)', '(Japan)', '(World)', '(USA, Europe)']
+    systems = sorted(SYSTEMS)
+    for number in range(size):
+        system = systems[number % len(systems)]
+        if number % UNKNOWN_RATIO == 0:
+            ext = 'bin'
+        else:
+            ext = rand.choice(SYSTEMS[system][1])
+        title = ' '.join(rand.sample(words, 2))
+        name = f'{title} {number % 100 + 1} {rand.choice(regions)}.{ext}'
+        yield (system, f'{number // FILES_PER_DIR:04d}', f'{number:07d} {name}')
+
+
+def write_fixture(fixture_dir, size):
+    # All generated data depends on the size and SEED only, so the same
+    # fixture is reused as long as its marker file exists.
+    marker = fixture_dir / 'complete'
+    if marker.exists():
+        return
+    home = fixture_dir / 'home'
+    ra_dir = home / '.config' / 'retroarch'
+    roms = []
+    dirs = set()
+    for system, subdir, name in get_rom_names(size):
+        path = fixture_dir / 'roms' / system / subdir / name
+        if path.parent not in dirs:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            dirs.add(path.parent)
+        with open(path, 'wb') as file:
+            file.write(b'\0' + name.encode()[:15])
+        roms.append(path.as_posix())
+
+    items = [{'path': path, 'label': pathlib.Path(path).stem,
+              'core_path': 'DETECT', 'core_name': 'DETECT', 'crc32': 'DETECT',
+              'db_name': 'Bench.lpl'} for path in roms]
+    write_file(ra_dir / 'playlists' / 'Bench.lpl', json.dumps(
+        {'version': '1.5', 'items': items}, indent=2))
+
+    lines = [f'libretro_directory = "{ra_dir / "cores"}"',
+             f'libretro_info_path = "{ra_dir / "info"}"',
+             f'playlist_directory = "{ra_dir / "playlists"}"',
+             f'content_history_path = "{ra_dir / "content_history.lpl"}"']
+    lines.extend(f'bench_option_{number} = "value {number}"'
+                 for number in range(CONFIG_LINES))
+    write_file(ra_dir / 'retroarch.cfg', '\n'.join(lines) + '\n')
+    write_file(ra_dir / 'content_history.lpl',
+               json.dumps({'version': '1.5', 'items': items[:100]}))
+
+    for core_file, extensions in SYSTEMS.values():
+        write_file(ra_dir / 'cores' / f'{core_file}_libretro.so', b'')
+        write_file(ra_dir / 'info' / f'{core_file}_libretro.info',
+                   f'supported_extensions = "{"|".join(extensions)}"\n')
+
+    settings = ['[retroarch]', 'bin = retroarch', f'dir = {ra_dir}',
+                f'config = {ra_dir / "retroarch.cfg"}',
+                'force_fullscreen = False', '', '[core]']
+    settings.extend(f'{core_id} = {core_file}'
+                    for core_id, (core_file, _) in SYSTEMS.items())
+    settings.extend(['', '[filetype]'])
+    settings.extend(f'*.x{number:04d} = nes'
+                    for number in range(FILETYPE_RULES))
+    settings.append(f'{fixture_dir / "roms" / "pce"}/* = pce')
+    settings.append('*(Japan)*.md = md')
+    settings.extend(f'*.{ext} = {core_id}' for core_id, (_, extensions)
+                    in SYSTEMS.items() for ext in extensions)
+    write_file(fixture_dir / 'settings.ini', '\n'.join(settings) + '\n')
+
+    write_file(fixture_dir / 'bin' / 'retroarch', '#!/bin/sh\nexit 0\n')
+    os.chmod(fixture_dir / 'bin' / 'retroarch', 0o755)
+    marker.touch()
+
+
+def get_stages(retroplay, fixture_dir, script_file):
+    home = fixture_dir / 'home'
+    ra_dir = home / '.config' / 'retroarch'
+    roms_dir = fixture_dir / 'roms'
+    settings_file = fixture_dir / 'settings.ini'
+    cache_dir = home / '.cache' / 'retroplay'
+    playlist_file = ra_dir / 'playlists' / 'Bench.lpl'
+    env = dict(os.environ, HOME=str(home),
+               PATH=f'{fixture_dir / "bin"}:{os.environ.get("PATH", "")}')
+
+    settings = retroplay.get_settings(settings_file)
+    core_inventory = retroplay.get_core_inventory(ra_dir / 'cores',
+                                                  ra_dir / 'info')
+    matcher = retroplay.get_filetype_matcher(settings, core_inventory)
+    paths = [pathlib.Path(path) for path, _ in
+             retroplay.get_playlist_items(playlist_file)]
+    sort_arguments = retroplay.get_arguments(['--sort-by', 'name,ext',
+                                              '--natural'])
+    resolve_arguments = retroplay.get_arguments(['--nostdin'])
+    query = retroplay.get_query(expression=('(core:snes or core:gb or ext:md)'
+                                            ' and not name:"(Japan)"'))
+    library_file = cache_dir / 'library.sqlite'
+
+    def clear_caches():
+        retroplay.MEMORY_CACHE.clear()
+        for path in cache_dir.glob('**/*'):
+            if path.is_file() and path != library_file:
+                path.unlink()
+
+    def scan(library):
+        return list(retroplay.get_dir_files(
+                [str(roms_dir)], library, matcher, False, None,
+                retroplay.SCAN_JOBS))
+
+    def scan_index():
+        library = retroplay.get_library_index(library_file, settings,
+                                              core_inventory)
+        try:
+            return scan(library)
+        finally:
+            library['connection'].close()
+
+    def resolve():
+        fresh_matcher = retroplay.get_filetype_matcher(settings,
+                                                       core_inventory)
+        return list(retroplay.get_launch_plans(
+                paths, resolve_arguments, settings, fresh_matcher,
+                ra_dir / 'cores', ra_dir / 'retroarch.cfg', '', '', False,
+                None, core_inventory))
+
+    def end_to_end():
+        command = [sys.executable, str(script_file), '--config',
+                   str(settings_file), '--nostdin', '--noindex', '-D', '-d',
+                   str(roms_dir), '--validate', '--sort-by', 'name',
+                   '--index', '1']
+        completed = subprocess.run(command, env=env, capture_output=True)
+        if completed.returncode:
+            raise RuntimeError(completed.stderr.decode(errors='replace'))
+        return paths
+
+    # Each stage is (setup, run), setup is not part of the measured time.
+    return {
+        'config': (clear_caches, lambda: retroplay.get_retroarch_config(
+                ra_dir / 'retroarch.cfg')),
+        'collect_dir': (clear_caches, lambda: scan(None)),
+        'collect_index': (scan_index, scan_index),
+        'collect_playlist': (clear_caches,
+                             lambda: retroplay.get_playlist_items(
+                                     playlist_file)),
+        'collect_playlist_cached': (retroplay.MEMORY_CACHE.clear,
+                                    lambda: retroplay.get_playlist_items(
+                                            playlist_file)),
+        'uniq': (None, lambda: list(retroplay.get_duplicates_removed(
+                paths + paths[::2], 'path'))),
+        'filter': (None, lambda: list(retroplay.get_filtered_list_query(
+                paths, query, settings, matcher))),
+        'sort': (None, lambda: list(retroplay.get_sorted_list(
+                paths, retroplay.get_sort_keys(sort_arguments), True, None,
+                settings, matcher))),
+        'validate': (None, lambda: list(retroplay.get_valid_list(
+                iter(paths), settings, 1, matcher, None,
+                retroplay.VALIDATE_JOBS, core_inventory))),
+        'resolve': (None, resolve),
+        'menu': (None, lambda: retroplay.get_rom_byshellpipe(
+                ['sh', '-c', 'cat > /dev/null'], iter(paths))),
+        'end_to_end': (None, end_to_end)
+    }
+
+
+def run_stage(setup, run, repeat):
+    times = []
+    count = 0
+    for _ in range(max(1, repeat)):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        result = run()
+        times.append(time.perf_counter() - start)
+        if isinstance(result, (list, dict)):
+            count = len(result)
+        elif isinstance(result, tuple):
+            count = result[1]
+    return {'min': min(times), 'median': statistics.median(times),
+            'items': count}
+
+
+def get_regressions(results, baseline, threshold, min_delta):
+    regressions = []
+    for key, result in results.items():
+        old = baseline.get(key)
+        if old is None:
+            continue
+        delta = result['min'] - old['min']
+        if delta > min_delta and result['min'] > old['min'] * (1 + threshold):
+            regressions.append((key, old['min'], result['min']))
+    return regressions
+
+
+def main():
+    arguments = get_arguments()
+    script_file = pathlib.Path(__file__).resolve().parent / 'retroplay.py'
+    sizes = [int(size) for size in arguments.sizes.split(',') if size]
+    stages = [stage.strip() for stage in arguments.stages.split(',')]
+    unknown = [stage for stage in stages if stage not in STAGES]
+    if unknown:
+        print(f'Unknown stage: "{unknown[0]}"', file=sys.stderr)
+        sys.exit(2)
+
+    retroplay = get_retroplay(script_file)
+    results = {}
+    for size in sizes:
+        fixture_dir = pathlib.Path(arguments.workdir).resolve() / str(size)
+        print(f'generating fixture with {size} files ...', file=sys.stderr)
+        write_fixture(fixture_dir, size)
+        os.environ['HOME'] = str(fixture_dir / 'home')
+        retroplay.MEMORY_CACHE.clear()
+        available = get_stages(retroplay, fixture_dir, script_file)
+        for stage in stages:
+            setup, run = available[stage]
+            result = run_stage(setup, run, arguments.repeat)
+            results[f'{stage}/{size}'] = result
+            print(f'{stage:>24} {size:>8} {result["min"]:10.4f}s'
+                  f' {result["median"]:10.4f}s {result["items"]:>8} items')
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'repeat': arguments.repeat,
+        'results': results
+    }
+    if arguments.output:
+        write_file(arguments.output, json.dumps(report, indent=2) + '\n')
+
+    if arguments.compare:
+        with open(arguments.compare, 'r') as file:
+            baseline = json.load(file)['results']
+        regressions = get_regressions(results, baseline, arguments.threshold,
+                                      arguments.min_delta)
+        for key, old, new in regressions:
+            print(f'REGRESSION {key}: {old:.4f}s -> {new:.4f}s'
+                  f' ({new / old:.2f}x)')
+        if regressions:
+            sys.exit(1)
+        print('no regressions')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,97 @@
-#!/usr/bin/python3
+#!/usr/bin/python3 -S
 
 # Copyright (c) 2021 Tuncay D.
 # MIT License, see LICENSE
 
+import time
 import sys
+STARTUP_TIME = time.perf_counter()
+STARTUP_MODULES = len(sys.modules)
+
+# Modules only needed by some code paths are imported in the functions using
+# them, so a plain launch or "--ls" does not pay for them at startup.
 import os
 import select
-import subprocess
 import argparse
 import configparser
 import pathlib
-import glob
-import tempfile
 import fnmatch
 import re
-import json
-import datetime
+import itertools
+
+
+LIBRARY_INDEX_FILE = '$HOME/.cache/retroplay/library.sqlite'
+LIBRARY_INDEX_VERSION = 3
+SCAN_JOBS = 8
+SCAN_ROOT_JOBS = 4
+HASH_JOBS = 8
+ARCHIVE_INDEX_FILE = '$HOME/.cache/retroplay/archives.sqlite'
+CHECKSUM_CACHE_FILE = '$HOME/.cache/retroplay/checksums.sqlite'
+CHECKSUM_BATCH = 256
+PLAYLIST_CACHE_DIR = '$HOME/.cache/retroplay/playlists'
+PLAYLIST_JOBS = 8
+PLAYLIST_CHUNK_SIZE = 1024 * 1024
+PLAYLIST_ITEMS_START = re.compile(r'"items"\s*:\s*\[')
+PATCH_CACHE_DIR = '$HOME/.cache/retroplay/patched'
+PATCH_CACHE_SIZE = 1024
+CORE_INVENTORY_CACHE_FILE = '$HOME/.cache/retroplay/cores.json'
+RETROARCH_CONFIG_CACHE_FILE = '$HOME/.cache/retroplay/retroarch_cfg.json'
+RETROARCH_CONFIG_LINE = re.compile(
+    r'^[ \t]*(?:'
+    r'#include[ \t]+"(?P<include>[^"\n]*)"'
+    r'|(?P<key>[^#=\s]+)[ \t]*=[ \t]*'
+    r'(?:"(?P<quoted>[^"\n]*)"|(?P<value>[^\s#]*))'
+    r')', re.MULTILINE)
+PREFETCH_MIN_SIZE = 4 * 1024 * 1024
+PREFETCH_MAX_SIZE = 2 * 1024 * 1024 * 1024
+RETROARCH_OUTPUT_LINES = 50
+RETROARCH_OUTPUT_LINE_MAX = 4096
+RETROARCH_LOG_SIZE = 8 * 1024 * 1024
+VALIDATE_JOBS = 8
+VALIDATE_BATCH = 256
+VALIDATE_SCANDIR_MIN = 8
+TIMINGS_AUDIT_EVENTS = {
+    'open': 'open',
+    'os.scandir': 'scandir',
+    'os.listdir': 'scandir',
+    'glob.glob': 'glob',
+    'subprocess.Popen': 'subprocess',
+    'os.posix_spawn': 'subprocess',
+    'os.fork': 'fork',
+    'sqlite3.connect': 'sqlite'
+}
+DAEMON_SOCKET_NAME = 'retroplay.sock'
+MEMORY_CACHE = {}
+MENU_CHUNK_MIN = 16
+MENU_CHUNK_MAX = 4096
+MENU_INDEX_CACHE_DIR = '$HOME/.cache/retroplay/menu'
+MENU_INDEX_CACHE_SIZE = 256 * 1024 * 1024
+MENU_SEARCH_IDS = 20000
+MIMETYPE_PROBE_SIZE = 4096
+HEADER_PROBE_SIZE = 512
+HEADER_SIGNATURES = (
+    # offset, magic bytes, file extension
+    (0x0, b'NES\x1a', 'nes'),
+    (0x0, b'FDS\x1a', 'fds'),
+    (0x0, b'\x01*NINTENDO-HVC*', 'fds'),
+    (0x0, b'\x80\x37\x12\x40', 'z64'),
+    (0x0, b'\x37\x80\x40\x12', 'v64'),
+    (0x0, b'\x40\x12\x37\x80', 'n64'),
+    (0x104, b'\xce\xed\x66\x66\xcc\x0d\x00\x0b', 'gb'),
+    (0x4, b'\x24\xff\xae\x51\x69\x9a\xa2\x21', 'gba'),
+    (0x100, b'SEGA 32X', '32x'),
+    (0x100, b'SEGA', 'md'),
+    (0x101, b'SEGA', 'md'),
+)
+QUERY_FIELDS = ('path', 'name', 'ext', 'core')
+QUERY_TOKEN = re.compile(r'[()]|[^\s()"]*"[^"]*"|[^\s()]+')
+QUERY_REGEX_CHARS = re.compile(r'[.^$*+?{}\[\]\\|()]')
+QUERY_UNSAFE_LITERAL_CHARS = re.compile(r'[|()\[\]\\{]')
+QUERY_LITERAL_RUN = re.compile(r'[^.^$*+?{}]+')
+SORT_KEYS = ('path', 'name', 'ext', 'core')
+NATURAL_SORT_SPLIT = re.compile(r'(\d+)')
+ASCII_TEXT_BYTES = bytes([7, 8, 9, 10, 11, 12, 13, 27]) + bytes(range(0x20,
+                                                                      0x7f))
 
 
 def get_meta(key=None):
@@ -37,7 +113,7 @@ def get_meta(key=None):
         return meta
 
 
-def get_arguments():
+def get_arguments(argv=None):
 
     parser = argparse.ArgumentParser(
         usage='%(prog)s ROM_FILE [options]',
@@ -115,10 +191,28 @@ def get_arguments():
     parser.add_argument(
         '--patch', '-p',
         metavar='FILE',
-        help=('path to a patch file to apply to the ROM on the fly, supported'
-             ' formats are ".ups", ".bps" and ".ips" files, it will create a'
-             ' temporary symbolic link file during the play session, wildcards'
-             ' are not supported')
+        help=('path to a patch file to apply to the ROM, supported formats'
+             ' are ".ups", ".bps" and ".ips" files, the patched ROM is stored'
+             ' in a cache and reused on later launches, wildcards are not'
+             ' supported')
+    )
+
+    parser.add_argument(
+        '--softpatch',
+        action='store_true',
+        help=('let RetroArch apply "--patch" on the fly to a temporary'
+             ' symbolic link of the ROM instead of using the cache, only works'
+             ' with cores supporting soft patching')
+    )
+
+    parser.add_argument(
+        '--patch-cache-size',
+        default=PATCH_CACHE_SIZE,
+        type=int,
+        metavar='MB',
+        help=('maximum size of all cached patched ROMs in megabytes, least'
+             ' recently used ones are removed first, defaults to'
+             f' {PATCH_CACHE_SIZE}')
     )
 
     parser.add_argument(
@@ -127,6 +221,15 @@ def get_arguments():
         help=('disable soft patch system entirely, regardless of any settings')
     )
 
+    parser.add_argument(
+        '--prefetch',
+        choices=['on', 'off'],
+        default='on',
+        help=('ask the kernel to read the selected ROM and core into the page'
+             ' cache in the background while the remaining checks run, files'
+             ' smaller than 4 MB are skipped, defaults to "on"')
+    )
+
     parser.add_argument(
         '--nostdin', '-Z',
         action='store_true',
@@ -138,11 +241,11 @@ def get_arguments():
     parser.add_argument(
         '--playlist', '-l',
         metavar='FILE',
-        nargs='?',
-        const='history',
-        help=('read all game entries from a RetroArch playlist in JSON format'
+        nargs='*',
+        help=('read all game entries from RetroArch playlists in JSON format'
              ' with file extension ".lpl", all entries with a tag "path" are'
-             ' added into a temporary list of ROM files, if playlist "FILE"'
+             ' added into a temporary list of ROM files, multiple "FILE" can'
+             ' be given and are loaded in parallel, if playlist "FILE"'
              ' does not contain any slash then the filename is searched in the'
              ' playlist folder of RetroArch, if "FILE" starts with a slash "/"'
              ' then it is handled as an absolute path, otherwise any "/" is'
@@ -150,8 +253,10 @@ def get_arguments():
              ' file extension ".lpl" is added automatically if missing, there'
              ' are two special keywords: "history" and "favorites", which'
              ' resolve to RetroArchs configured "content_history_path" and'
-             ' "content_favorites_path", default value is "history" if'
-             ' argument "FILE" is missing')
+             ' "content_favorites_path", the keyword "all" reads every'
+             ' playlist in the playlist folder of RetroArch, parsed playlists'
+             ' are cached until the file changes, default value is "history"'
+             ' if argument "FILE" is missing')
     )
 
     parser.add_argument(
@@ -163,6 +268,58 @@ def get_arguments():
             ' supported, but multiple paths separated by space can be given')
     )
 
+    parser.add_argument(
+        '--recursive', '-D',
+        action='store_true',
+        help=('read all subdirectories of each "PATH" at option "--dir" too,'
+             ' without any limit on how deep the directory tree goes')
+    )
+
+    parser.add_argument(
+        '--depth',
+        metavar='NUM',
+        type=int,
+        help=('like "--recursive", but only descend "NUM" levels of'
+             ' subdirectories below each "PATH" at option "--dir", "0" reads'
+             ' the given directory only, has higher priority than'
+             ' "--recursive"')
+    )
+
+    parser.add_argument(
+        '--scan-jobs',
+        metavar='NUM',
+        default=SCAN_JOBS,
+        type=int,
+        help=('maximum number of directories read at the same time with'
+             ' option "--dir", at most ' + str(SCAN_ROOT_JOBS) + ' of them'
+             ' belong to the same "PATH", defaults to "' + str(SCAN_JOBS) +
+             '"')
+    )
+
+    parser.add_argument(
+        '--reindex',
+        action='store_true',
+        help=('rescan every directory from option "--dir" and rebuild its'
+             ' entries in the library index, even if the directory did not'
+             ' change since last run')
+    )
+
+    parser.add_argument(
+        '--noindex',
+        action='store_true',
+        help=('do not read or write the library index at'
+             ' "$HOME/.cache/retroplay/library.sqlite", directories from'
+             ' option "--dir" are scanned directly on the filesystem')
+    )
+
+    parser.add_argument(
+        '--zip', '-z',
+        action='store_true',
+        help=('list the files inside of zip archives in the form'
+             ' "ARCHIVE.zip#FILE" instead of the archive itself, only the'
+             ' table of contents is read and cached, nothing is extracted')
+    )
+
     parser.add_argument(
         '--ls', '-o',
         action='store_true',
@@ -173,6 +330,29 @@ def get_arguments():
              'see option "--what" to output the current selected ROM file only')
     )
 
+    parser.add_argument(
+        '--resolve-all',
+        action='store_true',
+        help=('instead of selecting and running a single game, print one'
+             ' JSON object per line for every entry of the list, with the'
+             ' ROM path, core id, core path and RetroArch command, entries'
+             ' without a core have null values, nothing is run')
+    )
+
+    parser.add_argument(
+        '--checksum', '-k',
+        metavar='TYPE',
+        nargs='?',
+        const='crc32',
+        choices=['crc32', 'sha1'],
+        help=('add the checksum of each file in front of its path at option'
+             ' "--ls", separated by a tab, available types are "crc32" and'
+             ' "sha1", results are cached in'
+             ' "$HOME/.cache/retroplay/checksums.sqlite" until the file'
+             ' changes, "--checksum" without specifying "TYPE" defaults to'
+             ' "crc32"')
+    )
+
     parser.add_argument(
         '--what', '-w',
         action='store_true',
@@ -212,12 +392,13 @@ def get_arguments():
         metavar='MODE',
         nargs='?',
         const='dmenu',
-        choices=['dmenu', 'rofi'],
+        choices=['dmenu', 'rofi', 'tui'],
         help=('select a specific game by choosing it manually from the list'
              ' through a dynamically created menu, available systems at "MODE"'
              ' are "dmenu" and "rofi", which are external programs and needs'
-             ' to be installed separately on the system, "--menu" without'
-             ' specifying "MODE" defaults to "dmenu"')
+             ' to be installed separately on the system, and "tui", a built-in'
+             ' fuzzy search in the terminal over names and playlist labels,'
+             ' "--menu" without specifying "MODE" defaults to "dmenu"')
     )
 
     parser.add_argument(
@@ -251,6 +432,31 @@ def get_arguments():
              ' this case')
     )
 
+    parser.add_argument(
+        '--query', '-q',
+        metavar='EXPRESSION',
+        help=('exclude all entries not matching "EXPRESSION", which combines'
+             ' search terms with "and", "or", "not" and parentheses, a term'
+             ' has the form "FIELD:PATTERN" or just "PATTERN" to compare'
+             ' against the fullpath, available fields are "path", "name",'
+             ' "ext" and "core" (the core id from the settings), "PATTERN"'
+             ' works as in option "--filter", terms without an operator'
+             ' between them must all match, all "--filter" options are'
+             ' combined with this query into one pass over the list, example:'
+             ' --query "core:snes and (name:mario or name:zelda) and not'
+             ' ext:zip"')
+    )
+
+    parser.add_argument(
+        '--filter-checksum', '-K',
+        metavar='CHECKSUM',
+        nargs='+',
+        help=('exclude all entries whose file content does not match any of'
+             ' the given checksums, the checksum type is set by option'
+             ' "--checksum" and defaults to "crc32", comparison is case'
+             ' insensitive and an initial "0x" is ignored')
+    )
+
     parser.add_argument(
         '--validate', '--verify', '-v',
         action='store_true',
@@ -259,6 +465,16 @@ def get_arguments():
              ' pattern for this filetype is configured in the settings')
     )
 
+    parser.add_argument(
+        '--validate-jobs',
+        metavar='NUM',
+        default=VALIDATE_JOBS,
+        type=int,
+        help=('maximum number of directories checked at the same time by'
+             ' "--validate" and "--invalidate", defaults to "' +
+             str(VALIDATE_JOBS) + '"')
+    )
+
     parser.add_argument(
         '--invalidate', '-V',
         action='store_true',
@@ -268,8 +484,17 @@ def get_arguments():
 
     parser.add_argument(
         '--uniq', '-U',
-        action='store_true',
-        help=('filter out duplicate ROM path if more than one file is given')
+        metavar='MODE',
+        nargs='?',
+        const='path',
+        choices=['path', 'real', 'content'],
+        help=('filter out duplicate ROM path if more than one file is given,'
+             ' the first occurrence is kept, "MODE" defines when two entries'
+             ' are equal: "path" compares the path as written, "real"'
+             ' compares the resolved fullpath so symbolic links and "~" point'
+             ' to the same file, "content" compares the content of files'
+             ' with identical size, "--uniq" without specifying "MODE"'
+             ' defaults to "path"')
     )
 
     parser.add_argument(
@@ -295,6 +520,24 @@ def get_arguments():
              ' directory, has higher priority than "--sort" and "--sort-names"')
     )
 
+    parser.add_argument(
+        '--sort-by', '-b',
+        metavar='KEYS',
+        help=('sort all ROM path by a comma separated list of "KEYS", entries'
+             ' equal in the first key are ordered by the next key and so on,'
+             ' available keys are "path", "name", "ext" and "core" (the core'
+             ' id from the settings), has higher priority than "--sort-ext",'
+             ' "--sort-names" and "--sort", example: --sort-by ext,name,path')
+    )
+
+    parser.add_argument(
+        '--natural', '-x',
+        action='store_true',
+        help=('compare numbers within the sort keys by their numerical value,'
+             ' so "Game 2" comes before "Game 10", applies to all sort'
+             ' options')
+    )
+
     parser.add_argument(
         '--fullscreen', '-f',
         action='store_true',
@@ -309,6 +552,57 @@ def get_arguments():
              ' output stuff only (in example "--ls")')
     )
 
+    parser.add_argument(
+        '--log',
+        metavar='FILE',
+        help=('write the output of RetroArch to FILE while it runs, the file'
+             ' is rotated to "FILE.1" when it grows beyond 8 MB')
+    )
+
+    parser.add_argument(
+        '--exec',
+        action='store_true',
+        help=('replace this program with RetroArch instead of waiting for it,'
+             ' only if nothing has to be done after RetroArch exits, such as'
+             ' "--what", "--which" or "--log"')
+    )
+
+    parser.add_argument(
+        '--daemon',
+        action='store_true',
+        help=('keep running in the background and serve requests from'
+             ' "--client" over a Unix socket, settings, RetroArch config,'
+             ' core info and playlists stay in memory and are reloaded when'
+             ' their files change, directories are scanned on each request')
+    )
+
+    parser.add_argument(
+        '--client',
+        action='store_true',
+        help=('send this command with all other options, current directory,'
+             ' environment and stdin to a running "--daemon" and print its'
+             ' output, runs normally if no daemon is available')
+    )
+
+    parser.add_argument(
+        '--startup-profile',
+        action='store_true',
+        help=('print the time spent and the number of modules imported in'
+             ' each phase of the program to stderr when it exits, regardless'
+             ' of option "--quiet"')
+    )
+
+    parser.add_argument(
+        '--timings',
+        nargs='?',
+        const='-',
+        metavar='FILE',
+        help=('write wall-clock and CPU time of each phase, number of entries'
+             ' after each source and filter, number of stat, open, scandir,'
+             ' glob and subprocess calls and peak memory as JSON to FILE when'
+             ' the program exits, to stderr if FILE is omitted')
+    )
+
     parser.add_argument(
         '--quiet', '-Q',
         action='store_true',
@@ -371,7 +665,7 @@ def get_arguments():
              ' --addcore "snes:snes9x_libretro.so"')
     )
 
-    return parser.parse_args()
+    return parser.parse_args(argv)
 
 
 def write_default_settings(settings_file):
@@ -481,6 +775,7 @@ def get_path(path, useglob=False):
         fullpath = os.path.expandvars(path)
         fullpath = pathlib.Path(fullpath).expanduser()
         if useglob:
+            import glob
             path = fullpath.as_posix()
             path = re.sub(r'\[(.+?)\]', r'[[]\1[]]', path)
             fullpath = glob.glob(path)
@@ -496,6 +791,10 @@ def get_path(path, useglob=False):
 
 
 def get_settings(settings_file):
+    signature = get_file_signature(settings_file)
+    settings = get_memory_cached('settings', settings_file, signature)
+    if settings is not None:
+        return settings
     if settings_file and settings_file.exists():
         settings = configparser.ConfigParser()
         settings.optionxform = lambda option: option
@@ -506,23 +805,174 @@ def get_settings(settings_file):
             settings.add_section('core')
     else:
         settings = write_default_settings(settings_file)
+        signature = get_file_signature(settings_file)
+    set_memory_cached('settings', settings_file, signature, settings)
     return settings
 
 
+def get_memory_cached(kind, key, signature):
+    try:
+        cached_signature, value = MEMORY_CACHE[kind, str(key)]
+    except KeyError:
+        return None
+    if signature is None or cached_signature != signature:
+        return None
+    return value
+
+
+def set_memory_cached(kind, key, signature, value):
+    if signature is not None:
+        MEMORY_CACHE[kind, str(key)] = (signature, value)
+
+
 def get_retroarch_config_vars(ra_config_file, filter_list):
-    retroarch_config = {}
+    retroarch_config = get_retroarch_config(ra_config_file)
+    return {var: retroarch_config[var] for var in filter_list
+            if retroarch_config.get(var)}
+
+
+def get_retroarch_config(ra_config_file, cache_file=None):
+    import json
+    if cache_file is None:
+        cache_file = get_path(RETROARCH_CONFIG_CACHE_FILE)
+    key = str(ra_config_file)
+    # The cache entry lists every file read for this config, including
+    # those pulled in through "#include", and is only used if none of them
+    # changed.
+    entry = MEMORY_CACHE.get(('retroarch_config', key))
+    if entry and all(get_file_signature(path) == [size, mtime]
+                     for path, size, mtime in entry['files']):
+        return entry['config']
     try:
-        with open(ra_config_file, 'rt') as file:
-            for line in file:
-                for var in filter_list:
-                    if var in line:
-                        m = re.match(r'^' + var + r'\s*\=\s*"(.+)"', line)
-                        retroarch_config[var] = m.group(1)
-    except FileNotFoundError:
+        with open(cache_file, 'r') as file:
+            cache = json.load(file)
+    except (OSError, ValueError):
+        cache = {}
+    entry = cache.get(key)
+    if entry and all(get_file_signature(path) == [size, mtime]
+                     for path, size, mtime in entry['files']):
+        MEMORY_CACHE['retroarch_config', key] = entry
+        return entry['config']
+
+    retroarch_config = {}
+    files = []
+    if not parse_retroarch_config(ra_config_file, retroarch_config, files):
         return {}
+    cache[key] = {'files': files, 'config': retroarch_config}
+    MEMORY_CACHE['retroarch_config', key] = cache[key]
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(cache_file, 'w') as file:
+            json.dump(cache, file)
+    except OSError:
+        pass
     return retroarch_config
 
 
+def parse_retroarch_config(config_file, retroarch_config, files, depth=0):
+    signature = get_file_signature(config_file)
+    if signature is None or depth > 16:
+        return False
+    files.append([str(config_file)] + signature)
+    try:
+        with open(config_file, 'rt', errors='replace') as file:
+            data = file.read()
+    except OSError:
+        return False
+    for m in RETROARCH_CONFIG_LINE.finditer(data):
+        if m['include'] is not None:
+            # A relative path is relative to the including file, so it is
+            # joined before get_path() resolves it against the working
+            # directory.
+            include_file = pathlib.Path(
+                    os.path.expandvars(m['include'])).expanduser()
+            if not include_file.is_absolute():
+                include_file = pathlib.Path(config_file).parent / include_file
+            include_file = get_path(include_file)
+            if include_file:
+                parse_retroarch_config(include_file, retroarch_config, files,
+                                       depth + 1)
+        elif m['quoted'] is not None:
+            retroarch_config[m['key']] = m['quoted']
+        else:
+            retroarch_config[m['key']] = m['value']
+    return True
+
+
+def get_core_inventory(libretro_dir, info_dir, cache_file=None):
+    import json
+    if cache_file is None:
+        cache_file = get_path(CORE_INVENTORY_CACHE_FILE)
+    # Installing, updating or removing cores and info files replaces the
+    # files, which changes the modification time of their directories.
+    dirs = [[str(path)] + (get_file_signature(path) or [])
+            for path in (libretro_dir, info_dir)]
+    inventory = MEMORY_CACHE.get('core_inventory')
+    if inventory and inventory['dirs'] == dirs:
+        return inventory
+    try:
+        with open(cache_file, 'r') as file:
+            inventory = json.load(file)
+    except (OSError, ValueError):
+        inventory = None
+    if inventory and inventory.get('dirs') == dirs:
+        MEMORY_CACHE['core_inventory'] = inventory
+        return inventory
+
+    cores = {}
+    try:
+        with os.scandir(libretro_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith('_libretro.so'):
+                    cores[entry.name[:-12]] = entry.path
+    except OSError:
+        pass
+    extensions = {}
+    for core in sorted(cores):
+        try:
+            with open(pathlib.Path(info_dir, core + '_libretro.info'), 'rt',
+                      errors='replace') as file:
+                data = file.read()
+        except OSError:
+            continue
+        for m in RETROARCH_CONFIG_LINE.finditer(data):
+            if m['key'] == 'supported_extensions':
+                value = m['quoted'] if m['quoted'] is not None else m['value']
+                for ext in value.lower().split('|'):
+                    ext = ext.strip().lstrip('.')
+                    if ext and core not in extensions.get(ext, ()):
+                        extensions.setdefault(ext, []).append(core)
+                break
+    inventory = {'dirs': dirs, 'cores': cores, 'extensions': extensions}
+    MEMORY_CACHE['core_inventory'] = inventory
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(cache_file, 'w') as file:
+            json.dump(inventory, file)
+    except OSError:
+        pass
+    return inventory
+
+
+def get_inventory_core_path(core_inventory, core_file):
+    if not core_inventory or '/' in core_file:
+        return None
+    if core_file.endswith('.so'):
+        core_file = core_file[:-3]
+    if core_file.endswith('_libretro'):
+        core_file = core_file[:-9]
+    core_path = core_inventory['cores'].get(core_file)
+    return pathlib.Path(core_path) if core_path else None
+
+
+def get_file_signature(path):
+    try:
+        stat = os.stat(path)
+    except (OSError, TypeError):
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
 def get_playlist_file(playlist, ra_config):
     if playlist is not None:
         if playlist == 'history':
@@ -530,86 +980,503 @@ def get_playlist_file(playlist, ra_config):
         elif playlist == 'favorites':
             playlist_file = get_path(ra_config['content_favorites_path'])
         else:
+            if not playlist.endswith('.lpl'):
+                playlist += '.lpl'
             if '/' in playlist:
-                playlist_file = pathlib.PurePath(playlist)
-                playlist_file = playlist_file.with_suffix('.lpl')
                 playlist_file = get_path(playlist)
             else:
                 pl_dir= pathlib.PurePath(ra_config['playlist_directory'])
-                playlist_file = pathlib.PurePath(playlist)
-                playlist_file = get_path(
-                        pl_dir / playlist_file.with_suffix('.lpl')
-                )
+                playlist_file = get_path(pl_dir / playlist)
         return playlist_file
     else:
         return ''
 
 
-def get_playlist_data(playlist_file):
-    if playlist_file and playlist_file.exists():
-        with open(playlist_file, 'r') as file:
-            data = file.read()
-        try:
-            playlist_data = json.loads(data)
-        except JSONDecodeError:
-            return {}
-        return playlist_data
-    else:
-        return {}
-
-
-def get_playlist_item(playlist_data, tagname):
+def get_playlist_files(playlists, ra_config):
+    playlist_files = []
+    for playlist in playlists:
+        if playlist == 'all':
+            pl_dir = get_path(ra_config.get('playlist_directory', ''))
+            if pl_dir and pl_dir.is_dir():
+                playlist_files.extend(sorted(pl_dir.glob('*.lpl')))
+        else:
+            playlist_file = get_playlist_file(playlist, ra_config)
+            if playlist_file:
+                playlist_files.append(playlist_file)
+    return playlist_files
+
+
+def get_playlists_items(playlist_files, jobs=PLAYLIST_JOBS):
+    import concurrent.futures
+    items = []
+    with concurrent.futures.ThreadPoolExecutor(max(1, jobs)) as executor:
+        for playlist_items in executor.map(get_playlist_items,
+                                           playlist_files):
+            items.extend(playlist_items)
+    return items
+
+
+def get_playlist_items(playlist_file):
+    import hashlib
+    import marshal
+    signature = get_file_signature(playlist_file)
+    if signature is None:
+        return []
+    items = get_memory_cached('playlist', playlist_file, signature)
+    if items is not None:
+        return items
+    # Parsed playlists are stored in marshal format, which loads much faster
+    # than decoding the JSON again, as long as the playlist is unchanged.
+    cache_name = hashlib.sha1(str(playlist_file).encode()).hexdigest()
+    cache_file = get_path(PLAYLIST_CACHE_DIR) / (cache_name + '.marshal')
     try:
-        return [item[tagname] for item in playlist_data['items']]
-    except KeyError:
+        with open(cache_file, 'rb') as file:
+            cached_signature, items = marshal.load(file)
+        if cached_signature == signature:
+            set_memory_cached('playlist', playlist_file, signature, items)
+            return items
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+    try:
+        items = list(iter_playlist_items(playlist_file))
+    except OSError:
+        return []
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(cache_file, 'wb') as file:
+            marshal.dump((signature, items), file)
+    except OSError:
+        pass
+    set_memory_cached('playlist', playlist_file, signature, items)
+    return items
+
+
+def iter_playlist_items(playlist_file, chunk_size=PLAYLIST_CHUNK_SIZE):
+    import json
+    # Entries of the "items" array are decoded one at a time from a sliding
+    # buffer, so even huge history files never exist as one string.
+    decoder = json.JSONDecoder()
+    with open(playlist_file, 'r', errors='replace') as file:
+        buffer = ''
+        while True:
+            chunk = file.read(chunk_size)
+            buffer += chunk
+            m = PLAYLIST_ITEMS_START.search(buffer)
+            if m:
+                position = m.end()
+                break
+            if not chunk:
+                return
+            buffer = buffer[-64:]
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if position < len(buffer) and buffer[position] == ']':
+                return
+            try:
+                if position >= len(buffer):
+                    raise ValueError
+                item, position = decoder.raw_decode(buffer, position)
+            except ValueError:
+                chunk = file.read(chunk_size)
+                if not chunk:
+                    return
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+            if isinstance(item, dict) and item.get('path'):
+                yield (item['path'], item.get('label', ''))
+            if position > chunk_size:
+                buffer = buffer[position:]
+                position = 0
+
+
+def get_dir_files(dir_path, library=None, filetype_matcher=None,
+                  reindex=False, depth=0, jobs=SCAN_JOBS):
+    roots = []
+    for path in dir_path:
+        path = get_path(path)
+        if path and path.is_dir() and path.as_posix() not in roots:
+            roots.append(path.as_posix())
+    if not roots:
         return []
 
+    if reindex or library is None:
+        known_dirs = {}
+    else:
+        known_dirs = library['dirs']
+    scanned = scan_dir_tree(roots, depth, jobs, known_dirs,
+                            library is not None)
 
-def get_dir_files(dir_path):
     files = []
-    for path in dir_path:
-        path = get_path(path)
-        if path and path.is_dir():
-            files.extend(path.glob('*.*'))
-    if files:
-        return [p for p in files if p.is_file()]
+    stack = [(root, 0) for root in reversed(roots)]
+    while stack:
+        dir_name, level = stack.pop()
+        try:
+            dir_mtime, dir_files, subdirs = scanned[dir_name]
+        except KeyError:
+            continue
+        if library is None:
+            files.extend(pathlib.Path(path) for path, _, _ in dir_files)
+        else:
+            files.extend(get_indexed_dir_files(library, dir_name, dir_mtime,
+                                               dir_files, subdirs,
+                                               filetype_matcher))
+        if depth is None or level < depth:
+            stack.extend((subdir, level + 1) for subdir in reversed(subdirs))
+    if library is not None:
+        library['connection'].commit()
+    return files
+
+
+def read_dir_entries(dir_name, known_mtime=None, want_stat=False):
+    try:
+        dir_stat = os.stat(dir_name)
+    except OSError:
+        return None
+    dir_key = (dir_stat.st_dev, dir_stat.st_ino)
+    if known_mtime == dir_stat.st_mtime_ns:
+        return (dir_key, dir_stat.st_mtime_ns, None, None)
+    files = []
+    subdirs = []
+    try:
+        with os.scandir(dir_name) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                # is_dir() and is_file() are answered from d_type without a
+                # syscall, only symlinks and unusual filesystems need a stat.
+                try:
+                    if entry.is_dir():
+                        subdirs.append(entry.path)
+                    elif entry.is_file():
+                        if want_stat:
+                            stat = entry.stat()
+                            files.append((entry.path, stat.st_size,
+                                          stat.st_mtime_ns))
+                        else:
+                            files.append((entry.path, None, None))
+                except OSError:
+                    continue
+    except OSError:
+        return None
+    files.sort()
+    subdirs.sort()
+    return (dir_key, dir_stat.st_mtime_ns, files, subdirs)
+
+
+def scan_dir_tree(roots, depth=0, jobs=SCAN_JOBS, known_dirs=None,
+                  want_stat=False):
+    import concurrent.futures
+    if known_dirs is None:
+        known_dirs = {}
+    # Each root gets its own queue and at most SCAN_ROOT_JOBS directories in
+    # flight, so a slow network mount cannot occupy every worker of the pool.
+    pending = {root: [(root, 0, frozenset())] for root in roots}
+    running = {root: 0 for root in roots}
+    futures = {}
+    scanned = {}
+    with concurrent.futures.ThreadPoolExecutor(max(1, jobs)) as executor:
+        while True:
+            for root in roots:
+                while (pending[root] and running[root] < SCAN_ROOT_JOBS
+                       and len(futures) < max(1, jobs)):
+                    dir_name, level, parents = pending[root].pop()
+                    known_mtime = known_dirs.get(dir_name, (None, None))[0]
+                    future = executor.submit(read_dir_entries, dir_name,
+                                             known_mtime, want_stat)
+                    futures[future] = (root, dir_name, level, parents)
+                    running[root] += 1
+            if not futures:
+                break
+            done, _ = concurrent.futures.wait(
+                    futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                root, dir_name, level, parents = futures.pop(future)
+                running[root] -= 1
+                result = future.result()
+                # A symbolic link pointing back to one of its own parent
+                # directories would otherwise be followed forever.
+                if result is None or result[0] in parents:
+                    continue
+                dir_key, dir_mtime, files, subdirs = result
+                if files is None:
+                    subdirs = known_dirs[dir_name][1]
+                scanned[dir_name] = (dir_mtime, files, subdirs)
+                if depth is None or level < depth:
+                    parents = parents | {dir_key}
+                    pending[root].extend(
+                            (subdir, level + 1, parents)
+                            for subdir in reversed(subdirs))
+    return scanned
+
+
+def get_library_index(index_file, settings, core_inventory=None):
+    import json
+    import sqlite3
+    try:
+        index_file.parent.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(index_file)
+        row = connection.execute('PRAGMA user_version').fetchone()
+        if row[0] != LIBRARY_INDEX_VERSION:
+            connection.executescript(f'''
+                DROP TABLE IF EXISTS meta;
+                DROP TABLE IF EXISTS dirs;
+                DROP TABLE IF EXISTS files;
+                PRAGMA user_version = {LIBRARY_INDEX_VERSION};
+            ''')
+        connection.executescript('''
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS dirs (
+                path TEXT PRIMARY KEY, mtime INTEGER, subdirs TEXT);
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, dir TEXT, size INTEGER,
+                mtime INTEGER, core TEXT, ext TEXT, real TEXT);
+            CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+        ''')
+    except (OSError, sqlite3.Error):
+        return None
+    # Stored core ids are only valid for the [filetype] rules and installed
+    # cores they were resolved with, so any change there forces a rescan.
+    rules = json.dumps([settings.items('filetype'),
+                        core_inventory['extensions'] if core_inventory
+                        else None])
+    row = connection.execute(
+            "SELECT value FROM meta WHERE key = 'filetype'").fetchone()
+    if row is None or row[0] != rules:
+        with connection:
+            connection.execute('DELETE FROM dirs')
+            connection.execute(
+                    "REPLACE INTO meta VALUES ('filetype', ?)", (rules,))
+    dirs = {path: (mtime, json.loads(subdirs)) for path, mtime, subdirs
+            in connection.execute('SELECT path, mtime, subdirs FROM dirs')}
+    return {'connection': connection, 'dirs': dirs, 'cores': {},
+            'real_paths': {}}
+
+
+def get_indexed_dir_files(library, dir_name, dir_mtime, dir_files, subdirs,
+                          filetype_matcher):
+    import json
+    connection = library['connection']
+    if dir_files is None:
+        rows = connection.execute(
+                'SELECT path, dir, size, mtime, core, ext, real FROM files'
+                ' WHERE dir = ? ORDER BY path', (dir_name,)).fetchall()
     else:
-        return []
+        # The resolved path is stored as well, so "--validate" prints the
+        # same paths with and without the index.
+        real_dir = os.path.realpath(dir_name)
+        rows = []
+        for path, size, mtime in dir_files:
+            if os.path.islink(path):
+                real_path = os.path.realpath(path)
+            else:
+                real_path = os.path.join(real_dir, os.path.basename(path))
+            path = pathlib.Path(path)
+            rows.append((path.as_posix(), dir_name, size, mtime,
+                         get_core_name(None, path, filetype_matcher),
+                         path.suffix.lower().removeprefix('.'), real_path))
+        connection.execute('DELETE FROM files WHERE dir = ?', (dir_name,))
+        connection.executemany(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)',
+                rows)
+        connection.execute('REPLACE INTO dirs VALUES (?, ?, ?)',
+                           (dir_name, dir_mtime, json.dumps(subdirs)))
+    files = []
+    for row in rows:
+        library['cores'][row[0]] = row[4]
+        library['real_paths'][row[0]] = row[6]
+        files.append(pathlib.Path(row[0]))
+    return files
 
 
 def get_roms_list(arguments_nostdin, arguments_rom, arguments_game,
          playlist_item_path, dir_files):
     if arguments_game:
         arguments_rom.extend(arguments_game)
-    roms_list = [rom for rom in arguments_rom]
-    roms_list.extend(playlist_item_path)
-    roms_list.extend(dir_files)
+    for path in itertools.chain(arguments_rom, playlist_item_path, dir_files):
+        yield pathlib.PurePath(path)
     #if arguments_nostdin and not os.isatty(0):
     if not arguments_nostdin and select.select([sys.stdin,],[],[],0.0)[0]:
-        roms_list.extend([line for line in sys.stdin.read().splitlines()])
-    return [pathlib.PurePath(path) for path in roms_list]
+        for line in sys.stdin:
+            yield pathlib.PurePath(line.rstrip('\r\n'))
 
 
-def get_core_name(settings, rom_path):
-    rompath_lower = str(rom_path).lower()
-    items = settings.items('filetype')
-    items.reverse()
-    for item in items:
-        pattern = item[0]
-        core_name = settings.get('filetype', pattern)
+def get_archive_index(index_file):
+    import sqlite3
+    try:
+        index_file.parent.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(index_file)
+        connection.execute('''
+            CREATE TABLE IF NOT EXISTS archives (
+                path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER,
+                members TEXT)
+        ''')
+    except (OSError, sqlite3.Error):
+        return None
+    return connection
+
+
+def get_archive_members(archive_path, archive_index=None):
+    import json
+    import zipfile
+    signature = get_file_signature(archive_path)
+    if signature is None:
+        return None
+    key = str(archive_path)
+    members = get_memory_cached('archive', key, signature)
+    if members is not None:
+        return members
+    if archive_index is not None:
+        row = archive_index.execute(
+                'SELECT size, mtime, members FROM archives WHERE path = ?',
+                (key,)).fetchone()
+        if row is not None and list(row[:2]) == signature:
+            members = json.loads(row[2])
+            set_memory_cached('archive', key, signature, members)
+            return members
+    # ZipFile only reads the central directory at the end of the archive,
+    # which already has the name, size and CRC32 of each member.
+    try:
+        with zipfile.ZipFile(archive_path) as archive:
+            members = [[info.filename, info.file_size, f'{info.CRC:08x}']
+                       for info in archive.infolist() if not info.is_dir()]
+    except (OSError, ValueError, zipfile.BadZipFile):
+        members = []
+    if archive_index is not None:
+        archive_index.execute('REPLACE INTO archives VALUES (?, ?, ?, ?)',
+                              [key] + signature + [json.dumps(members)])
+    set_memory_cached('archive', key, signature, members)
+    return members
+
+
+def get_archive_expanded_list(roms_list, archive_index=None):
+    member_info = MEMORY_CACHE.setdefault('archive_members', {})
+    for path in roms_list:
+        text = str(path)
+        if text.lower().endswith('.zip'):
+            members = get_archive_members(get_path(text), archive_index)
+            # A launch stops reading the list at the selected entry, so
+            # whatever was read until then is saved before going on.
+            if archive_index is not None and archive_index.in_transaction:
+                archive_index.commit()
+            if members:
+                for name, size, crc in members:
+                    member_path = pathlib.PurePath(f'{text}#{name}')
+                    member_info[str(member_path)] = (size, crc)
+                    yield member_path
+                continue
+        yield path
+
+
+def get_archive_parts(path):
+    text = str(path)
+    position = text.lower().find('.zip#')
+    if position < 0:
+        return (text, '')
+    return (text[:position + 4], text[position + 5:])
+
+
+def get_archive_path(path):
+    return pathlib.Path(get_archive_parts(path)[0])
+
+
+def get_filetype_matcher(settings, core_inventory=None):
+    import glob
+    suffix_rules = {}
+    prefix_rules = []
+    wildcard_rules = []
+    for index, (pattern, core_name) in enumerate(settings.items('filetype')):
         if '/' in pattern:
-            pattern = get_path(pattern, True)
-        if fnmatch.fnmatch(rompath_lower, str(pattern).lower()):
-            return core_name
-    return ''
-
-
-def get_core_path(settings, core_name, libretro_dir):
+            pattern = os.path.expanduser(os.path.expandvars(pattern))
+            head, sep, tail = pattern.rpartition('/')
+            if tail == '*' and not glob.has_magic(head):
+                for prefix in {head, os.path.realpath(head)}:
+                    prefix_rules.append((index, prefix.lower() + '/', core_name))
+                continue
+        pattern = pattern.lower()
+        ext = pattern[1:]
+        if (pattern.startswith('*.') and not glob.has_magic(ext)
+                and '/' not in ext):
+            suffix_rules[ext] = (index, core_name)
+        else:
+            wildcard_rules.append((index, pattern, core_name))
+
+    # Alternatives are tried from left to right, so the rule with the highest
+    # priority (bottom of the section) must come first.
+    wildcard_rules.sort(reverse=True)
+    if wildcard_rules:
+        wildcard_regex = re.compile('|'.join(
+            f'(?P<r{i}>{fnmatch.translate(pattern)})'
+            for i, (_, pattern, _) in enumerate(wildcard_rules)
+        ))
+    else:
+        wildcard_regex = None
+
+    # Extensions of installed cores are only used for files no rule in
+    # section [filetype] matches, the core filename is used as core id.
+    inventory_rules = core_inventory['extensions'] if core_inventory else {}
+    memo = {}
+
+    def match(rom_path):
+        rompath_lower = str(rom_path).lower()
+        parent, _, name = rompath_lower.rpartition('/')
+        dot = name.find('.')
+        key = (parent, name[dot:] if dot >= 0 else '')
+        try:
+            best = memo[key]
+        except KeyError:
+            best = (-1, '')
+            tail = key[1]
+            while tail:
+                rule = suffix_rules.get(tail)
+                if rule and rule[0] > best[0]:
+                    best = rule
+                dot = tail.find('.', 1)
+                tail = tail[dot:] if dot >= 0 else ''
+            parent_slash = parent + '/'
+            for index, prefix, core_name in prefix_rules:
+                if index > best[0] and parent_slash.startswith(prefix):
+                    best = (index, core_name)
+            tail = key[1]
+            while tail and not best[1] and inventory_rules:
+                cores = inventory_rules.get(tail[1:])
+                if cores:
+                    best = (-1, cores[0])
+                dot = tail.find('.', 1)
+                tail = tail[dot:] if dot >= 0 else ''
+            memo[key] = best
+        if wildcard_regex is not None:
+            m = wildcard_regex.match(rompath_lower)
+            if m:
+                index, _, core_name = wildcard_rules[int(m.lastgroup[1:])]
+                if index > best[0]:
+                    best = (index, core_name)
+        return best[1]
+
+    return match
+
+
+def get_core_name(settings, rom_path, filetype_matcher=None, sniff=True):
+    if filetype_matcher is None:
+        filetype_matcher = get_filetype_matcher(settings)
+    core_name = filetype_matcher(rom_path)
+    if not core_name and sniff:
+        core_name = get_core_name_byheader(rom_path, filetype_matcher)
+    return core_name
+
+
+def get_core_path(settings, core_name, libretro_dir, core_inventory=None):
     try:
         core_path = settings.get('core', core_name)
     except (configparser.NoOptionError, configparser.NoSectionError):
-        return ''
+        # Core ids from the inventory are the core filenames themselves.
+        return get_inventory_core_path(core_inventory, core_name) or ''
     else:
+        inventory_path = get_inventory_core_path(core_inventory, core_path)
+        if inventory_path:
+            return inventory_path
         if '_libretro' not in core_path:
             core_path += '_libretro.so'
         if not core_path.endswith('.so'):
@@ -617,7 +1484,10 @@ def get_core_path(settings, core_name, libretro_dir):
         return get_path(libretro_dir / core_path)
 
 
-def get_core_path_byfilename(core_path, libretro_dir):
+def get_core_path_byfilename(core_path, libretro_dir, core_inventory=None):
+    inventory_path = get_inventory_core_path(core_inventory, core_path)
+    if inventory_path:
+        return inventory_path
     if '_libretro' not in core_path:
         core_path += '_libretro.so'
     if not core_path.endswith('.so'):
@@ -626,6 +1496,7 @@ def get_core_path_byfilename(core_path, libretro_dir):
 
 
 def get_record_file(path, rom_path):
+    import datetime
     if path == '=':
         record_file = rom_path.with_suffix('.mkv')
     else:
@@ -659,6 +1530,305 @@ def get_patch_file(path):
         return ('', '')
 
 
+def get_patched_rom(rom_path, patch_file, patch_format, cache_dir,
+                    cache_size):
+    # Patched ROMs are stored by the content of ROM and patch, so renamed or
+    # copied files still hit the cache.  The checksums themselves come from
+    # the checksum cache and cost a single stat on later launches.
+    checksums = get_checksums([rom_path, patch_file], 'sha1',
+                              get_checksum_cache(get_path(CHECKSUM_CACHE_FILE)),
+                              2)
+    if not checksums[rom_path] or not checksums[patch_file]:
+        raise ValueError('could not read rom or patch')
+    entry_dir = cache_dir / f'{checksums[rom_path]}_{checksums[patch_file]}'
+    patched_file = entry_dir / (patch_file.name + '_' + rom_path.name)
+    if patched_file.exists():
+        os.utime(entry_dir)
+        return patched_file
+
+    data = get_patch_applied(rom_path, patch_file, patch_format)
+    entry_dir.mkdir(parents=True, exist_ok=True)
+    temp_file = entry_dir / ('.' + patched_file.name + '.tmp')
+    with open(temp_file, 'wb') as file:
+        file.write(data)
+    os.replace(temp_file, patched_file)
+    trim_patch_cache(cache_dir, cache_size, entry_dir)
+    return patched_file
+
+
+def trim_patch_cache(cache_dir, cache_size, keep_dir=None):
+    import shutil
+    # The modification time of an entry is updated on each use, so the
+    # least recently used entries are removed first.
+    entries = []
+    total_size = 0
+    try:
+        with os.scandir(cache_dir) as dirs:
+            for entry in dirs:
+                if not entry.is_dir(follow_symlinks=False):
+                    continue
+                with os.scandir(entry.path) as files:
+                    size = sum(file.stat().st_size for file in files)
+                total_size += size
+                entries.append((entry.stat().st_mtime_ns, entry.path, size))
+    except OSError:
+        return
+    entries.sort()
+    for _, path, size in entries:
+        if total_size <= cache_size:
+            break
+        if keep_dir is not None and path == str(keep_dir):
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total_size -= size
+
+
+def get_patch_applied(rom_path, patch_file, patch_format):
+    import mmap
+    with open(patch_file, 'rb') as file:
+        patch = file.read()
+    with open(rom_path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size:
+            source = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            source = b''
+        try:
+            if patch_format == 'ips':
+                return get_ips_patched(source, patch)
+            elif patch_format == 'ups':
+                return get_ups_patched(source, patch)
+            elif patch_format == 'bps':
+                return get_bps_patched(source, patch)
+            raise ValueError(f'unsupported patch format "{patch_format}"')
+        finally:
+            if source:
+                source.close()
+
+
+def get_ips_patched(source, patch):
+    if patch[:5] != b'PATCH':
+        raise ValueError('not an IPS patch')
+    target = bytearray(source)
+    position = 5
+    while True:
+        record = patch[position:position + 3]
+        if len(record) < 3:
+            raise ValueError('IPS patch is truncated')
+        position += 3
+        if record == b'EOF':
+            # An optional 24 bit size after the end marker truncates the
+            # patched file.
+            if len(patch) - position == 3:
+                del target[int.from_bytes(patch[position:], 'big'):]
+            return bytes(target)
+        offset = int.from_bytes(record, 'big')
+        size = int.from_bytes(patch[position:position + 2], 'big')
+        position += 2
+        if size:
+            data = patch[position:position + size]
+            position += size
+        else:
+            size = int.from_bytes(patch[position:position + 2], 'big')
+            data = patch[position + 2:position + 3] * size
+            position += 3
+        if len(data) != size:
+            raise ValueError('IPS patch is truncated')
+        if offset + size > len(target):
+            target.extend(bytes(offset + size - len(target)))
+        target[offset:offset + size] = data
+
+
+def get_patch_number(patch, position):
+    # Variable length integers as used by UPS and BPS.
+    number = 0
+    shift = 1
+    while True:
+        if position >= len(patch):
+            raise ValueError('patch is truncated')
+        byte = patch[position]
+        position += 1
+        number += (byte & 0x7f) * shift
+        if byte & 0x80:
+            return (number, position)
+        shift <<= 7
+        number += shift
+
+
+def get_patch_footer(source, patch, magic):
+    import zlib
+    if patch[:4] != magic or len(patch) < 16:
+        raise ValueError(f'not a {magic[:3].decode()} patch')
+    source_crc, target_crc, patch_crc = (
+            int.from_bytes(patch[i:i + 4], 'little')
+            for i in range(len(patch) - 12, len(patch), 4))
+    if zlib.crc32(memoryview(patch)[:-4]) != patch_crc:
+        raise ValueError('patch checksum does not match, file is damaged')
+    if zlib.crc32(source) != source_crc:
+        raise ValueError('rom checksum does not match the patch')
+    return target_crc
+
+
+def get_ups_patched(source, patch):
+    import zlib
+    target_crc = get_patch_footer(source, patch, b'UPS1')
+    source_size, position = get_patch_number(patch, 4)
+    target_size, position = get_patch_number(patch, position)
+    if len(source) != source_size:
+        raise ValueError('rom size does not match the patch')
+    target = bytearray(source[:target_size])
+    target.extend(bytes(target_size - len(target)))
+    end = len(patch) - 12
+    offset = 0
+    while position < end:
+        skip, position = get_patch_number(patch, position)
+        offset += skip
+        # XOR data runs until a zero byte, which also skips one byte.
+        stop = patch.find(b'\0', position, end)
+        if stop < 0:
+            raise ValueError('patch is truncated')
+        length = min(stop - position, max(0, target_size - offset))
+        target[offset:offset + length] = (
+                int.from_bytes(target[offset:offset + length], 'little')
+                ^ int.from_bytes(patch[position:position + length], 'little')
+        ).to_bytes(length, 'little')
+        offset += stop - position + 1
+        position = stop + 1
+    if zlib.crc32(target) != target_crc:
+        raise ValueError('patched rom checksum does not match the patch')
+    return bytes(target)
+
+
+def get_bps_patched(source, patch):
+    import zlib
+    target_crc = get_patch_footer(source, patch, b'BPS1')
+    source_size, position = get_patch_number(patch, 4)
+    target_size, position = get_patch_number(patch, position)
+    metadata_size, position = get_patch_number(patch, position)
+    position += metadata_size
+    if len(source) != source_size:
+        raise ValueError('rom size does not match the patch')
+    target = bytearray(target_size)
+    end = len(patch) - 12
+    output = 0
+    source_offset = 0
+    target_offset = 0
+    while position < end:
+        data, position = get_patch_number(patch, position)
+        action = data & 3
+        length = (data >> 2) + 1
+        if output + length > target_size:
+            raise ValueError('patch writes beyond the target size')
+        if action == 0:
+            target[output:output + length] = source[output:output + length]
+        elif action == 1:
+            target[output:output + length] = patch[position:position + length]
+            position += length
+        elif action == 2:
+            data, position = get_patch_number(patch, position)
+            source_offset += -(data >> 1) if data & 1 else data >> 1
+            target[output:output + length] = source[
+                    source_offset:source_offset + length]
+            source_offset += length
+        else:
+            data, position = get_patch_number(patch, position)
+            target_offset += -(data >> 1) if data & 1 else data >> 1
+            # A copy overlapping its own output repeats the bytes between
+            # both offsets, like run-length encoding.
+            distance = output - target_offset
+            if distance <= 0:
+                raise ValueError('patch copies from unwritten data')
+            if distance >= length:
+                chunk = target[target_offset:target_offset + length]
+            else:
+                pattern = target[target_offset:output]
+                chunk = (pattern * (length // distance + 1))[:length]
+            target[output:output + length] = chunk
+            target_offset += length
+        output += length
+    if zlib.crc32(target) != target_crc:
+        raise ValueError('patched rom checksum does not match the patch')
+    return bytes(target)
+
+
+def start_prefetch(path, min_size=PREFETCH_MIN_SIZE,
+                   max_size=PREFETCH_MAX_SIZE):
+    import threading
+    # The hint can block on slow disks or network filesystems, so it is given
+    # from a thread and never delays the program itself.
+    thread = threading.Thread(target=prefetch_file,
+                              args=(path, min_size, max_size), daemon=True)
+    thread.start()
+    return thread
+
+
+def prefetch_file(path, min_size=PREFETCH_MIN_SIZE,
+                  max_size=PREFETCH_MAX_SIZE):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except (OSError, TypeError, ValueError):
+        return
+    try:
+        size = os.fstat(fd).st_size
+        if size < min_size:
+            return
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, min(size, max_size),
+                             os.POSIX_FADV_WILLNEED)
+        else:
+            import mmap
+            with mmap.mmap(fd, min(size, max_size),
+                           access=mmap.ACCESS_READ) as data:
+                data.madvise(mmap.MADV_WILLNEED)
+    except (OSError, ValueError, AttributeError):
+        pass
+    finally:
+        os.close(fd)
+
+
+def run_retroarch(command, log_file=None, lines=RETROARCH_OUTPUT_LINES):
+    import subprocess
+    import collections
+    # Output is read while RetroArch runs, so the pipe never fills up and
+    # only the last lines are kept in memory, for an error report.
+    recent = collections.deque(maxlen=lines)
+    log = None
+    if log_file:
+        try:
+            log_file.parent.mkdir(parents=True, exist_ok=True)
+            log = open(log_file, 'ab')
+        except OSError:
+            log = None
+    try:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+    except OSError as error:
+        if log is not None:
+            log.close()
+        return (127, [str(error)])
+    with process:
+        for line in iter(lambda: process.stdout.readline(
+                RETROARCH_OUTPUT_LINE_MAX), b''):
+            recent.append(line)
+            if log is not None:
+                log = write_log_line(log, log_file, line)
+    if log is not None:
+        log.close()
+    return (process.returncode,
+            [line.decode(errors='replace').rstrip('\r\n') for line in recent])
+
+
+def write_log_line(log, log_file, line, max_size=RETROARCH_LOG_SIZE):
+    try:
+        log.write(line)
+        if log.tell() > max_size:
+            log.close()
+            os.replace(log_file, str(log_file) + '.1')
+            log = open(log_file, 'wb')
+    except OSError:
+        pass
+    return log
+
+
 def get_command(retroarch_bin_path,
                 arguments,
                 core_path,
@@ -682,6 +1852,78 @@ def get_command(retroarch_bin_path,
     return command
 
 
+def get_launch_plans(roms_list, arguments, settings, filetype_matcher,
+                     libretro_dir, ra_config_file, patch_file, patch_format,
+                     fullscreen, checksums=None, core_inventory=None):
+    # Core ids are memoized per directory and extension by the matcher, the
+    # core paths are looked up only once per core id for the whole batch.
+    core_paths = {}
+    if arguments.libretro:
+        if '/' in arguments.libretro:
+            libretro_path = get_path(arguments.libretro)
+        else:
+            libretro_path = get_core_path_byfilename(arguments.libretro,
+                                                     libretro_dir,
+                                                     core_inventory)
+    for path in roms_list:
+        rom_path = get_path(path)
+        if not rom_path:
+            continue
+        if arguments.libretro:
+            core_name = ''
+            core_path = libretro_path
+        else:
+            if arguments.core:
+                core_name = arguments.core
+            else:
+                core_name = get_core_name(settings, rom_path,
+                                          filetype_matcher)
+            try:
+                core_path = core_paths[core_name]
+            except KeyError:
+                core_path = get_core_path(settings, core_name, libretro_dir,
+                                          core_inventory)
+                if core_path and not core_path.exists():
+                    core_path = ''
+                core_paths[core_name] = core_path
+        if arguments.record and arguments.record_disable_macros:
+            record_file = get_path(arguments.record)
+        elif arguments.record:
+            record_file = get_record_file(arguments.record, rom_path)
+        else:
+            record_file = ''
+        if core_path:
+            command = get_command(None, arguments, core_path, rom_path,
+                                  ra_config_file, record_file, patch_file,
+                                  patch_format, fullscreen)
+        else:
+            command = None
+        plan = {
+            'rom': rom_path.as_posix(),
+            'core': core_name or None,
+            'core_path': core_path.as_posix() if core_path else None,
+            'command': command
+        }
+        if checksums is not None:
+            plan['checksum'] = checksums.get(path)
+        yield plan
+
+
+def write_launch_plans(plans):
+    import json
+    count = 0
+    lines = []
+    for plan in plans:
+        lines.append(json.dumps(plan))
+        count += 1
+        if len(lines) >= MENU_CHUNK_MAX:
+            print('\n'.join(lines))
+            lines = []
+    if lines:
+        print('\n'.join(lines))
+    return count
+
+
 def get_existing_roms_list(rom_path, roms_list):
     existing_roms_list = []
     if rom_path.exists():
@@ -693,120 +1935,906 @@ def get_existing_roms_list(rom_path, roms_list):
     return existing_roms_list
 
 
-def get_duplicates_removed(oldlist):
-        newlist = []
-        for line in oldlist:
-            if line not in newlist:
-                newlist.append(line)
-        return  newlist
+def get_duplicates_removed(oldlist, mode='path'):
+    if mode == 'content':
+        yield from get_content_duplicates_removed(oldlist)
+        return
+    seen = set()
+    for line in oldlist:
+        if mode == 'real':
+            key = get_path(line) or line
+        else:
+            key = line
+        if key not in seen:
+            seen.add(key)
+            yield line
+
+
+def get_content_duplicates_removed(oldlist, jobs=HASH_JOBS):
+    import concurrent.futures
+    # Only files sharing their size with another file can have the same
+    # content, so everything else is never opened.
+    entries = [(line, str(get_path(line) or line)) for line in oldlist]
+    sizes = {}
+    for key in dict.fromkeys(key for _, key in entries):
+        try:
+            size = os.stat(key).st_size
+        except OSError:
+            continue
+        sizes.setdefault(size, []).append(key)
+    colliding = [key for group in sizes.values() if len(group) > 1
+             for key in group]
+    with concurrent.futures.ThreadPoolExecutor(max(1, jobs)) as executor:
+        digests = dict(zip(colliding, executor.map(get_file_checksum,
+                                                   colliding)))
+    seen = set()
+    for line, key in entries:
+        digest = digests.get(key)
+        if digest:
+            key = ('content', digest)
+        if key not in seen:
+            seen.add(key)
+            yield line
+
+
+def get_file_checksum(path, algorithm='sha1'):
+    import mmap
+    import zlib
+    import hashlib
+    try:
+        with open(path, 'rb') as file:
+            if os.fstat(file.fileno()).st_size:
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                if hasattr(data, 'madvise'):
+                    data.madvise(mmap.MADV_SEQUENTIAL)
+            else:
+                data = b''
+            # zlib and hashlib release the GIL on large buffers, so several
+            # of these can run in parallel from a thread pool.
+            if algorithm == 'crc32':
+                checksum = f'{zlib.crc32(data):08x}'
+            else:
+                checksum = hashlib.sha1(data).hexdigest()
+            if data:
+                data.close()
+    except (OSError, ValueError):
+        return ''
+    return checksum
 
 
-def get_filtered_list(pathlist, pattern):
-    if pattern.isalnum():
-        pattern = pattern.lower()
-        return [path for path in pathlist if
-                pattern in path.as_posix().lower()]
+def get_checksum_cache(cache_file):
+    import sqlite3
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(cache_file)
+        connection.execute('''
+            CREATE TABLE IF NOT EXISTS checksums (
+                dev INTEGER, ino INTEGER, size INTEGER, mtime INTEGER,
+                algorithm TEXT, checksum TEXT,
+                PRIMARY KEY (dev, ino, size, mtime, algorithm))
+        ''')
+    except (OSError, sqlite3.Error):
+        return None
+    return connection
+
+
+def get_checksums(roms_list, algorithm='crc32', cache=None, jobs=HASH_JOBS):
+    import concurrent.futures
+    # Files are identified by device, inode, size and mtime, so a warm cache
+    # answers with a single stat and a primary key lookup per file and never
+    # reads its content.
+    member_info = MEMORY_CACHE.get('archive_members', {})
+
+    checksums = {}
+    keys = {}
+    for path in roms_list:
+        member = member_info.get(str(path))
+        if member is not None:
+            # Files inside of archives are never extracted, only the CRC32
+            # from the table of contents is available.
+            checksums[path] = member[1] if algorithm == 'crc32' else ''
+            continue
+        try:
+            stat = os.stat(get_path(path))
+        except (OSError, TypeError):
+            checksums[path] = ''
+            continue
+        key = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        row = None
+        if cache is not None:
+            row = cache.execute(
+                    'SELECT checksum FROM checksums WHERE dev = ? AND ino = ?'
+                    ' AND size = ? AND mtime = ? AND algorithm = ?',
+                    key + (algorithm,)).fetchone()
+        if row is not None:
+            checksums[path] = row[0]
+        else:
+            keys[path] = key
+
+    def get_checksum(path):
+        return get_file_checksum(get_path(path), algorithm)
+
+    with concurrent.futures.ThreadPoolExecutor(max(1, jobs)) as executor:
+        results = executor.map(get_checksum, keys)
+        for path, checksum in zip(keys, results):
+            checksums[path] = checksum
+            if checksum and cache is not None:
+                cache.execute(
+                        'REPLACE INTO checksums VALUES (?, ?, ?, ?, ?, ?)',
+                        keys[path] + (algorithm, checksum))
+    if cache is not None and keys:
+        cache.commit()
+    return {path: checksums[path] for path in roms_list}
+
+
+def get_checksummed_list(roms_list, checksums, algorithm='crc32', cache=None,
+                         jobs=HASH_JOBS, batch_size=CHECKSUM_BATCH):
+    while True:
+        batch = list(itertools.islice(roms_list, batch_size))
+        if not batch:
+            break
+        checksums.update(get_checksums(batch, algorithm, cache, jobs))
+        yield from batch
+
+
+def get_filtered_list_checksum(pathlist, checksums, values):
+    values = {value.lower().removeprefix('0x') for value in values}
+    return (path for path in pathlist if checksums.get(path) in values)
+
+
+def get_query(filters=None, filters_names=None, filters_ext=None,
+              expression=None):
+    terms = []
+    for field, patterns in (('ext', filters_ext), ('name', filters_names),
+                            ('path', filters)):
+        for pattern in patterns or []:
+            terms.append(get_query_term(field, pattern))
+    if expression:
+        terms.append(parse_query(expression))
+    if not terms:
+        return None
+    return get_query_and(terms)
+
+
+def get_query_term(field, pattern):
+    if field not in QUERY_FIELDS:
+        raise ValueError(f'unknown field "{field}"')
+    if pattern.isalnum() or not QUERY_REGEX_CHARS.search(pattern):
+        literal = pattern.lower()
+        def match(fields):
+            return literal in fields[field]
     else:
-        return [path for path in pathlist if
-                re.search(pattern, path.as_posix().lower(), re.IGNORECASE)]
+        try:
+            regex = re.compile(pattern, re.IGNORECASE)
+        except re.error as error:
+            raise ValueError(f'"{pattern}": {error}')
+        literal = get_query_literal(pattern).lower()
+        # A substring that every match must contain is much cheaper to test
+        # than the regular expression and rejects most entries early.
+        if literal:
+            def match(fields):
+                value = fields[field]
+                return literal in value and regex.search(value) is not None
+        else:
+            def match(fields):
+                return regex.search(fields[field]) is not None
+    match.fields = {field}
+    return match
 
 
-def get_filtered_list_names(pathlist, pattern):
-    if pattern.isalnum():
-        pattern = pattern.lower()
-        return [path for path in pathlist if
-                pattern in path.stem.lower()]
+def get_query_literal(pattern):
+    # Alternation, groups, classes, escapes and counted repetitions can make
+    # any run of plain characters optional, so no literal is required then.
+    if QUERY_UNSAFE_LITERAL_CHARS.search(pattern):
+        return ''
+    literals = []
+    for m in QUERY_LITERAL_RUN.finditer(pattern):
+        literal = m.group()
+        if pattern[m.end():m.end() + 1] in ('?', '*'):
+            literal = literal[:-1]
+        literals.append(literal)
+    literal = max(literals, key=len, default='')
+    return literal if len(literal) > 1 else ''
+
+
+def get_query_and(terms):
+    if len(terms) == 1:
+        return terms[0]
+    def match(fields):
+        return all(term(fields) for term in terms)
+    match.fields = set().union(*(term.fields for term in terms))
+    return match
+
+
+def get_query_or(terms):
+    if len(terms) == 1:
+        return terms[0]
+    def match(fields):
+        return any(term(fields) for term in terms)
+    match.fields = set().union(*(term.fields for term in terms))
+    return match
+
+
+def get_query_not(term):
+    def match(fields):
+        return not term(fields)
+    match.fields = term.fields
+    return match
+
+
+def parse_query(expression):
+    tokens = QUERY_TOKEN.findall(expression)
+    position = 0
+
+    def peek():
+        return tokens[position].lower() if position < len(tokens) else None
+
+    def parse_or():
+        nonlocal position
+        terms = [parse_and()]
+        while peek() == 'or':
+            position += 1
+            terms.append(parse_and())
+        return get_query_or(terms)
+
+    def parse_and():
+        nonlocal position
+        terms = [parse_not()]
+        while peek() not in (None, 'or', ')'):
+            if peek() == 'and':
+                position += 1
+            terms.append(parse_not())
+        return get_query_and(terms)
+
+    def parse_not():
+        nonlocal position
+        if peek() == 'not':
+            position += 1
+            return get_query_not(parse_not())
+        if peek() == '(':
+            position += 1
+            term = parse_or()
+            if peek() != ')':
+                raise ValueError('missing ")"')
+            position += 1
+            return term
+        if peek() in (None, 'and', 'or', ')'):
+            raise ValueError('missing search term')
+        token = tokens[position]
+        position += 1
+        field, sep, pattern = token.partition(':')
+        if not sep or field.lower() not in QUERY_FIELDS:
+            field = 'path'
+            pattern = token
+        return get_query_term(field.lower(), pattern.strip('"'))
+
+    if not tokens:
+        raise ValueError('empty query')
+    query = parse_or()
+    if position < len(tokens):
+        raise ValueError(f'unexpected "{tokens[position]}"')
+    return query
+
+
+def get_filtered_list_query(pathlist, query, settings=None,
+                            filetype_matcher=None):
+    if 'core' in query.fields and filetype_matcher is None:
+        filetype_matcher = get_filetype_matcher(settings)
+    # Only the fields the query refers to are computed, once per entry.
+    getters = {
+        'path': lambda path: path.as_posix().lower(),
+        'name': lambda path: path.stem.lower(),
+        'ext': lambda path: path.suffix.lower().removeprefix('.'),
+        'core': lambda path: get_core_name(settings, path,
+                                           filetype_matcher).lower(),
+    }
+    getters = [(field, getters[field]) for field in query.fields]
+    for path in pathlist:
+        fields = {field: getter(path) for field, getter in getters}
+        if query(fields):
+            yield path
+
+
+def get_sort_keys(arguments):
+    if arguments.sort_by:
+        keys = [key.strip().lower() for key in arguments.sort_by.split(',')]
+        for key in keys:
+            if key not in SORT_KEYS:
+                raise ValueError(f'unknown sort key "{key}"')
+        return keys
+    elif arguments.sort_ext:
+        return ['ext']
+    elif arguments.sort_names:
+        return ['name']
+    elif arguments.sort:
+        return ['path']
     else:
-        return [path for path in pathlist if
-                re.search(pattern, path.stem.lower(), re.IGNORECASE)]
+        return []
 
 
-def get_filtered_list_ext(pathlist, pattern):
-    if pattern.isalnum():
-        pattern = pattern.lower()
-        return [path for path in pathlist if
-                pattern in path.suffix.lower().removeprefix('.')]
+def get_sort_key(keys, natural=False, settings=None, filetype_matcher=None):
+    if 'core' in keys and filetype_matcher is None:
+        filetype_matcher = get_filetype_matcher(settings)
+
+    if natural:
+        # Splitting on digit runs always alternates text and number, so
+        # numbers are compared with numbers and "Game 2" sorts before
+        # "Game 10".
+        def convert(text):
+            parts = NATURAL_SORT_SPLIT.split(text)
+            parts[1::2] = map(int, parts[1::2])
+            return tuple(parts)
+    else:
+        def convert(text):
+            return text
+
+    getters = []
+    for key in keys:
+        if key == 'path':
+            getters.append(lambda path, name, ext: path)
+        elif key == 'name':
+            getters.append(lambda path, name, ext: name[:len(name) - len(ext)])
+        elif key == 'ext':
+            getters.append(lambda path, name, ext: ext)
+        elif key == 'core':
+            getters.append(lambda path, name, ext: get_core_name(
+                settings, path, filetype_matcher))
+
+    def sort_key(path):
+        path = path.as_posix().lower()
+        name = path.rpartition('/')[2]
+        dot = name.rfind('.')
+        ext = name[dot:] if 0 < dot < len(name) - 1 else ''
+        return tuple(convert(getter(path, name, ext)) for getter in getters)
+
+    return sort_key
+
+
+def get_sorted_list(roms_list, keys, natural=False, limit=None, settings=None,
+                    filetype_matcher=None):
+    import heapq
+    sort_key = get_sort_key(keys, natural, settings, filetype_matcher)
+    # Only the first few entries are needed to select by positive index, so
+    # a heap avoids sorting the whole list.  nsmallest() keeps the order of
+    # equal entries just like a stable sort.
+    if limit:
+        return heapq.nsmallest(limit, roms_list, key=sort_key)
+    return sorted(roms_list, key=sort_key)
+
+
+def get_valid_list(roms_list, settings, valid_mode, filetype_matcher=None,
+                   library=None, jobs=VALIDATE_JOBS, core_inventory=None):
+    import concurrent.futures
+    import stat
+    if filetype_matcher is None:
+        filetype_matcher = get_filetype_matcher(settings, core_inventory)
+    indexed_cores = library['cores'] if library else {}
+    indexed_paths = library['real_paths'] if library else {}
+    dir_listings = {}
+    installed_cores = {}
+
+    def has_core(core_name):
+        # With the core inventory a core id is only valid if its core is
+        # installed, which is answered once per core id without any stat.
+        if not core_name or core_inventory is None:
+            return bool(core_name)
+        try:
+            return installed_cores[core_name]
+        except KeyError:
+            pass
+        try:
+            core_file = settings.get('core', core_name)
+        except (configparser.NoOptionError, configparser.NoSectionError):
+            core_file = core_name
+        if '/' in core_file:
+            installed = os.path.exists(get_path(core_file))
+        else:
+            installed = bool(get_inventory_core_path(core_inventory,
+                                                     core_file))
+        installed_cores[core_name] = installed
+        return installed
+
+    def check_dir(parent, names):
+        # A directory with many requested entries is listed once with
+        # scandir, instead of a stat for each of the files.
+        real_parent = os.path.realpath(parent)
+        if parent in dir_listings:
+            return (real_parent, dir_listings[parent], True)
+        found = {}
+        if len(names) >= VALIDATE_SCANDIR_MIN:
+            try:
+                with os.scandir(parent) as entries:
+                    for entry in entries:
+                        found[entry.name] = entry.is_symlink()
+            except OSError:
+                pass
+            return (real_parent, found, True)
+        for name in names:
+            try:
+                mode = os.lstat(os.path.join(parent, name)).st_mode
+            except OSError:
+                continue
+            found[name] = stat.S_ISLNK(mode)
+        return (real_parent, found, False)
+
+    def check_header(path):
+        return get_core_name(settings, path, filetype_matcher)
+
+    with concurrent.futures.ThreadPoolExecutor(max(1, jobs)) as executor:
+        while True:
+            batch = list(itertools.islice(roms_list, VALIDATE_BATCH))
+            if not batch:
+                break
+
+            # Group all entries not known from the library index by their
+            # directory, so each directory is checked only once per batch.
+            entries = []
+            groups = {}
+            for path in batch:
+                core_name = indexed_cores.get(str(path))
+                if core_name is not None:
+                    entries.append((pathlib.Path(indexed_paths[str(path)]),
+                                    None, None, '', has_core(core_name)))
+                    continue
+                archive, member = get_archive_parts(path)
+                parent, name = get_path_parts(archive)
+                entries.append((path, parent, name, member, None))
+                if parent is not None:
+                    groups.setdefault(parent, set()).add(name)
+            futures = {parent: executor.submit(check_dir, parent, names)
+                       for parent, names in groups.items()}
+            dirs = {}
+            for parent, future in futures.items():
+                dirs[parent] = future.result()
+                if dirs[parent][2]:
+                    dir_listings[parent] = dirs[parent][1]
+
+            results = []
+            unknown = []
+            for path, parent, name, member, valid in entries:
+                if valid is None and parent is None:
+                    valid = False
+                elif valid is None:
+                    real_parent, found, _ = dirs[parent]
+                    is_symlink = found.get(name)
+                    if is_symlink:
+                        file_path = get_path(os.path.join(parent, name))
+                    else:
+                        file_path = pathlib.Path(real_parent, name)
+                    # Files inside of archives keep their "#" suffix.
+                    if member:
+                        path = pathlib.Path(f'{file_path}#{member}')
+                    else:
+                        path = file_path
+                    if is_symlink is None or (is_symlink
+                                              and not file_path.exists()):
+                        valid = False
+                    else:
+                        core_name = filetype_matcher(path)
+                        valid = has_core(core_name)
+                        if not core_name:
+                            # Needs a look into the header of the file.
+                            unknown.append(len(results))
+                results.append([path, valid])
+            for position, core_name in zip(unknown, executor.map(
+                    check_header, [results[i][0] for i in unknown])):
+                results[position][1] = has_core(core_name)
+
+            for path, valid in results:
+                # validate
+                if valid_mode == 1 and valid:
+                    yield path
+                # invalidate
+                elif valid_mode == 2 and not valid:
+                    yield path
+
+
+def get_path_parts(path):
+    path = str(path)
+    if path.startswith('file://'):
+        path = path[7:]
+    try:
+        path = os.path.abspath(os.path.expanduser(os.path.expandvars(path)))
+    except (KeyError, RuntimeError, ValueError):
+        return (None, None)
+    parent, name = os.path.split(path)
+    if not name:
+        return (None, None)
+    return (parent, name)
+
+
+def get_output_line(path, checksums=None):
+    if checksums is None:
+        return path.as_posix()
     else:
-        return [path for path in pathlist if
-                re.search(pattern, path.suffix.lower().removeprefix('.'),
-                    re.IGNORECASE)]
+        return checksums.get(path, '') + '\t' + path.as_posix()
 
 
-def get_valid_list(roms_list, settings, valid_mode):
-    newlist = []
-    for path in roms_list:
-        path = get_path(path)
+def iter_deferred(function, *args):
+    yield from function(*args)
 
 
-def get_valid_list(roms_list, settings, valid_mode):
-    newlist = []
+def get_rom_byindex(roms_list, index=1, output=False, checksums=None):
+    import collections
+    # Positive index stops reading the stream at the selected entry, unless
+    # every entry must be printed anyway.  Zero or negative index only keeps
+    # the last few entries around.
+    if index > 0:
+        recent = None
+    else:
+        recent = collections.deque(maxlen=1 - index)
+    rom_path = ''
+    count = 0
     for path in roms_list:
-        path = get_path(path)
-        valid = bool(get_core_name(settings, path) and path.exists())
-        # validate
-        if valid_mode == 1 and valid:
-            newlist.append(path)
-        # invalidate
-        elif valid_mode == 2 and not valid:
-            newlist.append(path)
-    return newlist
-
-
-def get_rom_byindex(roms_list, index=1):
-    if index == 0:
-        index = len(roms_list)
-    index -= 1
-    try:
-        return roms_list[index]
-    except IndexError:
-        return ''
-
-
-def get_rom_bydmenu(roms_list):
-    stdin_data = '\n'.join(str(i) for i in roms_list)
+        count += 1
+        if output:
+            print(get_output_line(path, checksums))
+        if recent is not None:
+            recent.append(path)
+        elif count == index:
+            rom_path = path
+            if not output:
+                break
+    if recent is not None and len(recent) == recent.maxlen:
+        rom_path = recent[0]
+    return (rom_path, count)
+
+
+def get_rom_bydmenu(roms_list, output=False, checksums=None):
     command = ['dmenu', '-i', '-l', '15']
-    return get_rom_byshellpipe(command, stdin_data)
+    return get_rom_byshellpipe(command, roms_list, output, checksums)
 
 
-def get_rom_byrofi(roms_list):
-    stdin_data = '\n'.join(str(i) for i in roms_list)
+def get_rom_byrofi(roms_list, output=False, checksums=None):
     command = ['rofi', '-dmenu', '-i']
-    return get_rom_byshellpipe(command, stdin_data)
+    return get_rom_byshellpipe(command, roms_list, output, checksums)
+
+
+def get_menu_index(texts, cache_dir=None, cache_size=MENU_INDEX_CACHE_SIZE):
+    import array
+    import hashlib
+    import marshal
+    if cache_dir is None:
+        cache_dir = get_path(MENU_INDEX_CACHE_DIR)
+    cache_name = hashlib.sha1('\n'.join(texts).encode(
+            errors='replace')).hexdigest()
+    cache_file = cache_dir / (cache_name + '.marshal')
+    try:
+        with open(cache_file, 'rb') as file:
+            data = marshal.load(file)
+        trigrams = {}
+        for trigram, ids in data.items():
+            trigrams[trigram] = array.array('I')
+            trigrams[trigram].frombytes(ids)
+        os.utime(cache_file)
+        return {'texts': texts, 'trigrams': trigrams}
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+
+    trigrams = {}
+    for position, text in enumerate(texts):
+        for trigram in get_trigrams(text):
+            try:
+                trigrams[trigram].append(position)
+            except KeyError:
+                trigrams[trigram] = array.array('I', [position])
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        with open(cache_file, 'wb') as file:
+            marshal.dump({trigram: ids.tobytes()
+                          for trigram, ids in trigrams.items()}, file)
+    except OSError:
+        pass
+    trim_menu_index_cache(cache_dir, cache_size, cache_file)
+    return {'texts': texts, 'trigrams': trigrams}
+
+
+def trim_menu_index_cache(cache_dir, cache_size, keep_file=None):
+    # Each list of entries gets its own index file, the modification time is
+    # updated on each use, so the least recently used ones are removed first.
+    entries = []
+    total_size = 0
+    try:
+        with os.scandir(cache_dir) as files:
+            for entry in files:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                stat = entry.stat()
+                total_size += stat.st_size
+                entries.append((stat.st_mtime_ns, entry.path, stat.st_size))
+    except OSError:
+        return
+    entries.sort()
+    for _, path, size in entries:
+        if total_size <= cache_size:
+            break
+        if keep_file is not None and path == str(keep_file):
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total_size -= size
+
+
+def get_trigrams(text):
+    text = f' {text} '
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def search_menu_index(menu_index, query, limit):
+    import collections
+    import heapq
+    texts = menu_index['texts']
+    query = query.lower()
+    if not query:
+        return list(range(min(limit, len(texts))))
+    trigrams = menu_index['trigrams']
+
+    def get_sorted(matches):
+        return sorted(matches, key=lambda i: (not texts[i].startswith(query),
+                                              len(texts[i])))[:limit]
+
+    if len(query) < 3:
+        # Every substring of an entry is part of one of its trigrams, so the
+        # matching trigrams lead to the matches without a scan of all texts,
+        # word starts first.
+        keys = sorted((trigram for trigram in trigrams if query in trigram),
+                      key=lambda trigram: not trigram.startswith(' ' + query))
+        matches = set()
+        for trigram in keys:
+            matches.update(position for position
+                           in trigrams[trigram][:limit * 4]
+                           if query in texts[position])
+            if len(matches) >= limit * 4:
+                break
+        return get_sorted(matches)
+
+    # An entry containing the query has every trigram inside of the query,
+    # so the rarest of them holds all substring matches.  The trigrams at
+    # the padded ends of the query only help ranking.
+    rarest = min((trigrams.get(query[i:i + 3], ())
+                  for i in range(len(query) - 2)), key=len)
+    matches = []
+    for position in rarest:
+        if query in texts[position]:
+            matches.append(position)
+            if len(matches) >= limit * 4:
+                break
+    if len(matches) >= limit or len(rarest) > MENU_SEARCH_IDS:
+        return get_sorted(matches)
+
+    # Entries sharing most trigrams with the query come next, so a typo only
+    # costs a few trigrams instead of dropping the entry.  Counting is done
+    # from the rarest trigram up, until MENU_SEARCH_IDS positions were
+    # counted, as common trigrams like "(us" say little about an entry but
+    # cost the most to count.
+    postings = sorted((ids for ids in (trigrams.get(trigram, ())
+                                       for trigram in get_trigrams(query))
+                       if ids), key=len)
+    counts = collections.Counter()
+    counted = 0
+    for ids in postings:
+        if counted and counted + len(ids) > MENU_SEARCH_IDS:
+            break
+        counts.update(ids)
+        counted += len(ids)
+    candidates = dict(heapq.nlargest(limit * 4, counts.items(),
+                                     key=lambda item: item[1]))
+    candidates.update((position, counts[position]) for position in matches)
+    candidates = candidates.items()
+
+    def score(item):
+        position, count = item
+        text = texts[position]
+        bonus = 0
+        if query in text:
+            bonus = 1000 if text.startswith(query) else 500
+        return (-(count + bonus), len(text))
+
+    return [position for position, _ in sorted(candidates, key=score)][:limit]
+
+
+def get_rom_bytui(roms_list, labels=None):
+    import curses
+    labels = {str(pathlib.PurePath(path)): label
+              for path, label in (labels or {}).items()}
+    entries = [str(path) for path in roms_list]
+    display = []
+    texts = []
+    for entry in entries:
+        name = pathlib.PurePath(entry).stem
+        label = labels.get(entry, '')
+        display.append(f'{label}  ({entry})' if label else entry)
+        texts.append(f'{label} {name}'.lower() if label else name.lower())
+    menu_index = get_menu_index(texts)
+
+    def run(screen):
+        curses.curs_set(1)
+        query = ''
+        selected = 0
+        while True:
+            height, width = screen.getmaxyx()
+            results = search_menu_index(menu_index, query, max(1, height - 1))
+            selected = min(selected, max(0, len(results) - 1))
+            screen.erase()
+            for row, position in enumerate(results):
+                attribute = curses.A_REVERSE if row == selected else 0
+                screen.addnstr(row + 1, 0, display[position], width - 1,
+                               attribute)
+            screen.addnstr(0, 0, '> ' + query, width - 1)
+            screen.move(0, min(len(query) + 2, width - 1))
+            screen.refresh()
+            key = screen.get_wch()
+            if key in ('\n', '\r', curses.KEY_ENTER):
+                return entries[results[selected]] if results else ''
+            elif key == '\x1b':
+                return ''
+            elif key in ('\x7f', '\b', curses.KEY_BACKSPACE):
+                query = query[:-1]
+                selected = 0
+            elif key == curses.KEY_UP:
+                selected = max(0, selected - 1)
+            elif key == curses.KEY_DOWN:
+                selected += 1
+            elif isinstance(key, str) and key.isprintable():
+                query += key
+                selected = 0
+
+    # stdin and stdout might be pipes, so the terminal is attached directly
+    # for the duration of the menu.
+    try:
+        tty = os.open('/dev/tty', os.O_RDWR)
+    except OSError:
+        return ''
+    saved_fds = (os.dup(0), os.dup(1))
+    try:
+        os.dup2(tty, 0)
+        os.dup2(tty, 1)
+        return curses.wrapper(run)
+    except (curses.error, KeyboardInterrupt):
+        return ''
+    finally:
+        os.dup2(saved_fds[0], 0)
+        os.dup2(saved_fds[1], 1)
+        for fd in saved_fds + (tty,):
+            os.close(fd)
 
 
-def get_rom_byshellpipe(command, stdin_data=''):
+def get_rom_byshellpipe(command, roms_list, output=False, checksums=None):
+    import subprocess
     try:
-        p = subprocess.run(command,
+        p = subprocess.Popen(command,
+                stdin=subprocess.PIPE,
                 stdout=subprocess.PIPE,
-                input=stdin_data,
                 text=True
         )
-        selection = p.stdout.strip('\n')
-        if p.returncode == 0 and len(selection):
-            return selection
-        else:
-            return ''
     except FileNotFoundError:
-        return ''
+        p = None
+
+    # The menu is fed while the list is still being produced.  Chunks start
+    # small, so the first entries show up right away, and grow to keep the
+    # number of writes low on long lists.
+    count = 0
+    chunk = []
+    chunk_size = MENU_CHUNK_MIN
+    for path in roms_list:
+        count += 1
+        if output:
+            print(get_output_line(path, checksums))
+        if p is None:
+            continue
+        chunk.append(str(path) + '\n')
+        if len(chunk) >= chunk_size:
+            write_menu_chunk(p, chunk)
+            chunk = []
+            chunk_size = min(chunk_size * 2, MENU_CHUNK_MAX)
+    if p is None:
+        return ('', count)
+    write_menu_chunk(p, chunk)
+    try:
+        p.stdin.close()
+    except BrokenPipeError:
+        pass
+    selection = p.stdout.read().strip('\n')
+    if p.wait() == 0 and len(selection):
+        return (selection, count)
+    else:
+        return ('', count)
+
+
+def write_menu_chunk(p, chunk):
+    if p.stdin.closed:
+        return
+    try:
+        p.stdin.write(''.join(chunk))
+        p.stdin.flush()
+    except BrokenPipeError:
+        # Menu was closed before the list was complete, whatever it printed
+        # is still read afterwards.
+        try:
+            p.stdin.close()
+        except BrokenPipeError:
+            pass
 
 def get_mimetype(path, brief=False):
-    command = []
-    command.append('file')
-    command.append('--mime-encoding')
-    command.append('--brief')
-    command.append(str(path))
+    import codecs
+    try:
+        with open(path, 'rb') as file:
+            data = file.read(MIMETYPE_PROBE_SIZE)
+    except (OSError, TypeError):
+        return ''
+    # Same rules as "file --mime-encoding": any byte outside of the printable
+    # range of an encoding makes the data binary.
+    if not data or b'\x00' in data:
+        return 'binary'
+    if not data.translate(None, ASCII_TEXT_BYTES):
+        return 'us-ascii'
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(data)
+    except UnicodeDecodeError:
+        pass
+    else:
+        if not data.translate(None, ASCII_TEXT_BYTES + bytes(range(0x80,
+                                                                    0x100))):
+            return 'utf-8'
+    if not data.translate(None, ASCII_TEXT_BYTES + bytes(range(0xa0,
+                                                                0x100))):
+        return 'iso-8859-1'
+    return 'binary'
+
+
+def get_header_filetype(path):
     try:
-        completed_process = subprocess.run(command,
-                capture_output=True,
-                text=True,
-                check=True)
-        if completed_process.returncode == 0:
-            return str(completed_process.stdout).strip('\n')
-    except Exception:
+        with open(path, 'rb') as file:
+            header = file.read(HEADER_PROBE_SIZE)
+
+            def read_at(offset, size):
+                if offset + size <= len(header):
+                    return header[offset:offset + size]
+                file.seek(offset)
+                return file.read(size)
+
+            for offset, magic, filetype in HEADER_SIGNATURES:
+                if read_at(offset, len(magic)) == magic:
+                    if filetype == 'gb' and read_at(0x143, 1) in (b'\x80',
+                                                                  b'\xc0'):
+                        return 'gbc'
+                    return filetype
+
+            # SNES internal header, with and without a 512 byte copier header
+            # in front, is recognized by its checksum and complement.
+            for offset in (0x7fc0, 0xffc0, 0x81c0, 0x101c0):
+                data = read_at(offset, 0x20)
+                if len(data) < 0x20 or data[0x15] & 0xe0 != 0x20:
+                    continue
+                complement = int.from_bytes(data[0x1c:0x1e], 'little')
+                checksum = int.from_bytes(data[0x1e:0x20], 'little')
+                if complement ^ checksum == 0xffff:
+                    return 'sfc'
+
+            for offset in (0x7ff0, 0x3ff0, 0x1ff0):
+                data = read_at(offset, 0x10)
+                if data[:8] == b'TMR SEGA':
+                    # The region code is in the last byte, a truncated header
+                    # is taken as Master System.
+                    if len(data) == 0x10 and data[0xf] >> 4 in (5, 6, 7):
+                        return 'gg'
+                    return 'sms'
+    except OSError:
         return ''
     return ''
 
 
+def get_core_name_byheader(path, filetype_matcher):
+    filetype = get_header_filetype(path)
+    if filetype:
+        # Let the [filetype] rules decide as if the file had the extension
+        # matching its content.
+        return filetype_matcher(f'{path}.{filetype}')
+    return ''
+
+
 def check_requirements(meta):
     minpython = meta['minpython'].split('.')
     if (sys.version_info[0] < int(minpython[0])
@@ -823,35 +2851,374 @@ def stderr(message, quiet):
         sys.stderr.write(str(message) + '\n')
 
 def get_retroarch_bin_path(command):
-    command = ['which', command]
+    if '/' in command:
+        candidates = [command]
+    else:
+        candidates = [os.path.join(path or '.', command) for path in
+                      os.environ.get('PATH', os.defpath).split(os.pathsep)]
+    for retroarch_bin_path in candidates:
+        if (os.path.isfile(retroarch_bin_path)
+                and os.access(retroarch_bin_path, os.X_OK)):
+            return retroarch_bin_path
+    return None
+
+
+def add_startup_phase(startup_profile, name):
+    startup_profile.append((name, time.perf_counter(), len(sys.modules),
+                            time.process_time()))
+
+
+def write_startup_profile(startup_profile):
+    add_startup_phase(startup_profile, 'exit')
+    previous_time = STARTUP_TIME
+    previous_modules = STARTUP_MODULES
+    for name, phase_time, modules, _ in startup_profile:
+        stderr(f'{name:<10} {(phase_time - previous_time) * 1000:8.2f} ms'
+               f'  {modules - previous_modules:+4d} modules', False)
+        previous_time = phase_time
+        previous_modules = modules
+    stderr(f'{"total":<10} {(previous_time - STARTUP_TIME) * 1000:8.2f} ms'
+           f'  {len(sys.modules):4d} modules', False)
+
+
+def start_timings():
+    timings = {'entries': {},
+               'calls': dict.fromkeys(['stat', 'open', 'scandir', 'glob',
+                                       'subprocess', 'fork', 'sqlite'], 0)}
+    calls = timings['calls']
+
+    # There are no audit events for stat, so the os functions used by
+    # pathlib and os.path are replaced with counting ones.
+    def audit(event, args):
+        name = TIMINGS_AUDIT_EVENTS.get(event)
+        if name is not None:
+            calls[name] += 1
+
+    def get_counted(function):
+        def counted(*args, **kwargs):
+            calls['stat'] += 1
+            return function(*args, **kwargs)
+        return counted
+
+    sys.addaudithook(audit)
+    os.stat = get_counted(os.stat)
+    os.lstat = get_counted(os.lstat)
+    return timings
+
+
+def get_counted_list(roms_list, entries, name):
+    entries[name] = 0
+    for path in roms_list:
+        entries[name] += 1
+        yield path
+
+
+def write_timings(startup_profile, timings, timings_file):
+    import json
+    import resource
+    add_startup_phase(startup_profile, 'exit')
+    phases = []
+    previous_time = STARTUP_TIME
+    previous_cpu = 0.0
+    for name, phase_time, _, phase_cpu in startup_profile:
+        phases.append({'name': name,
+                       'wall': round(phase_time - previous_time, 6),
+                       'cpu': round(phase_cpu - previous_cpu, 6)})
+        previous_time = phase_time
+        previous_cpu = phase_cpu
+    report = {
+        'phases': phases,
+        'wall': round(previous_time - STARTUP_TIME, 6),
+        'cpu': round(previous_cpu, 6),
+        'entries': timings['entries'],
+        'calls': timings['calls'],
+        'modules': len(sys.modules),
+        # Linux reports the resident set size in kilobytes.
+        'peak_memory_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'children_peak_memory_kb': resource.getrusage(
+                resource.RUSAGE_CHILDREN).ru_maxrss
+    }
+    if timings_file == '-':
+        sys.stderr.write(json.dumps(report) + '\n')
+        return
+    try:
+        with open(get_path(timings_file), 'w') as file:
+            json.dump(report, file, indent=2)
+    except OSError as error:
+        stderr(f'Could not write timings: "{timings_file}" ({error})', False)
+
+
+def get_daemon_socket_file():
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir and os.path.isdir(runtime_dir):
+        return pathlib.Path(runtime_dir) / DAEMON_SOCKET_NAME
+    import tempfile
+    return (pathlib.Path(tempfile.gettempdir())
+            / f'retroplay-{os.getuid()}-{DAEMON_SOCKET_NAME}')
+
+
+def recv_exact(connection, size):
+    data = b''
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def run_client(socket_file, argv):
+    import socket
+    import struct
+    import json
+    request = json.dumps({
+        'argv': [arg for arg in argv if arg != '--client'],
+        'cwd': os.getcwd(),
+        'env': dict(os.environ)
+    }).encode()
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(str(socket_file))
+    except OSError:
+        client.close()
+        return None
+    with client:
+        # The daemon writes directly to our stdin, stdout and stderr, so
+        # the only thing coming back over the socket is the exit status.
+        socket.send_fds(client, [struct.pack('!I', len(request))],
+                        [0, 1, 2])
+        client.sendall(request)
+        status = recv_exact(client, 4)
+    if status is None:
+        return 1
+    return struct.unpack('!i', status)[0]
+
+
+def get_silent_arguments(argv):
+    import io
+    import contextlib
+    # Parses without printing usage, help or errors, which are left to the
+    # process actually running the command.
+    try:
+        with contextlib.redirect_stdout(io.StringIO()), \
+                contextlib.redirect_stderr(io.StringIO()):
+            return get_arguments(argv)
+    except SystemExit:
+        return None
+
+
+def warm_daemon_caches(argv):
+    # Loads the files a request reads from disk into MEMORY_CACHE of the
+    # daemon itself, so the forked process serving the request and all
+    # following ones start with them.  Directories are left to the forked
+    # process, as a long scan here would hold up every other client.
+    arguments = get_silent_arguments(argv)
+    if arguments is None:
+        return
+    settings = get_settings(get_path(arguments.settings))
+    ra_config_file = get_path(settings.get(
+        'retroarch', 'config',
+        fallback='$HOME/.config/retroarch/retroarch.cfg'))
+    ra_config = get_retroarch_config_vars(
+        ra_config_file, ['playlist_directory', 'content_history_path',
+                         'content_favorites_path', 'libretro_directory',
+                         'libretro_info_path'])
+    if 'libretro_directory' in ra_config:
+        libretro_dir = get_path(ra_config['libretro_directory'])
+        get_core_inventory(
+                libretro_dir,
+                get_path(ra_config.get('libretro_info_path', libretro_dir)))
+    if arguments.playlist is not None and ra_config:
+        get_playlists_items(get_playlist_files(arguments.playlist
+                                               or ['history'], ra_config))
+
+
+def run_daemon_request(fds, request):
+    import atexit
+    import traceback
+    global STARTUP_TIME, STARTUP_MODULES
+    STARTUP_TIME = time.perf_counter()
+    STARTUP_MODULES = len(sys.modules)
+    for target, fd in enumerate(fds):
+        os.dup2(fd, target)
+        os.close(fd)
+    sys.argv = [sys.argv[0]] + request['argv']
+    os.environ.clear()
+    os.environ.update(request['env'])
     try:
-        completed_process = subprocess.run(command,
-                capture_output=True,
-                check=True,
-                text=True)
-        if completed_process.returncode == 0:
-            retroarch_bin_path = completed_process.stdout.rstrip('\n')
-            if retroarch_bin_path.startswith('which:'):
-                retroarch_bin_path = None
+        os.chdir(request['cwd'])
+    except OSError as error:
+        print(f'Could not change to working directory: {error}',
+              file=sys.stderr)
+        os._exit(1)
+    try:
+        main()
+        status = 0
+    except SystemExit as error:
+        if error.code is None:
+            status = 0
+        elif isinstance(error.code, int):
+            status = error.code
         else:
-            retroarch_bin_path = None
-    except subprocess.CalledProcessError:
-        retroarch_bin_path = None
-    return retroarch_bin_path
+            print(error.code, file=sys.stderr)
+            status = 1
+    except BaseException:
+        traceback.print_exc()
+        status = 1
+    # os._exit() skips the exit handlers, such as the one of "--timings".
+    atexit._run_exitfuncs()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(status)
+
+
+def run_daemon(socket_file, quiet=False):
+    import socket
+    import struct
+    import json
+    import signal
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(str(socket_file))
+    except OSError:
+        pass
+    else:
+        message = f'Daemon is already running: "{socket_file}"'
+        stderr(message, quiet)
+        sys.exit(1)
+    finally:
+        client.close()
+    try:
+        socket_file.unlink()
+    except FileNotFoundError:
+        pass
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o177)
+    try:
+        server.bind(str(socket_file))
+    finally:
+        os.umask(old_umask)
+    server.listen(16)
+
+    # Finished requests are noticed through SIGCHLD waking up select(), so
+    # the daemon needs no threads and forking stays safe.
+    wakeup_read, wakeup_write = os.pipe()
+    os.set_blocking(wakeup_read, False)
+    os.set_blocking(wakeup_write, False)
+    signal.set_wakeup_fd(wakeup_write)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    children = {}
+    daemon_cwd = os.getcwd()
+    daemon_env = dict(os.environ)
+    try:
+        while True:
+            readable, _, _ = select.select([server, wakeup_read], [], [])
+            if wakeup_read in readable:
+                try:
+                    os.read(wakeup_read, 4096)
+                except BlockingIOError:
+                    pass
+                while children:
+                    pid, wait_status = os.waitpid(-1, os.WNOHANG)
+                    if not pid:
+                        break
+                    connection = children.pop(pid, None)
+                    if connection is None:
+                        continue
+                    status = os.waitstatus_to_exitcode(wait_status)
+                    if status < 0:
+                        status = 128 - status
+                    try:
+                        connection.sendall(struct.pack('!i', status))
+                    except OSError:
+                        pass
+                    connection.close()
+            if server not in readable:
+                continue
+
+            connection, _ = server.accept()
+            try:
+                header, fds, _, _ = socket.recv_fds(connection, 4, 3)
+                request = None
+                if len(header) == 4 and len(fds) == 3:
+                    data = recv_exact(connection,
+                                      struct.unpack('!I', header)[0])
+                    request = json.loads(data) if data else None
+            except (OSError, ValueError):
+                request = None
+            if request is None:
+                for fd in fds:
+                    os.close(fd)
+                connection.close()
+                continue
+
+            # A broken request must not take the daemon down, its errors are
+            # reported to the client by the forked process instead.
+            try:
+                os.chdir(request['cwd'])
+                os.environ.clear()
+                os.environ.update(request['env'])
+                warm_daemon_caches(request['argv'])
+            except Exception as error:
+                stderr(f'Could not load caches for request: {error!r}', quiet)
+            finally:
+                os.chdir(daemon_cwd)
+                os.environ.clear()
+                os.environ.update(daemon_env)
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if pid == 0:
+                signal.set_wakeup_fd(-1)
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                server.close()
+                os.close(wakeup_read)
+                os.close(wakeup_write)
+                connection.close()
+                run_daemon_request(fds, request)
+            for fd in fds:
+                os.close(fd)
+            children[pid] = connection
+    finally:
+        server.close()
+        try:
+            socket_file.unlink()
+        except OSError:
+            pass
 
 
 def get_isfrozen():
     return getattr(sys, 'frozen', False) and hasattr(sys, '_MEIPASS')
 
 
-if __name__ == '__main__':
+def main():
 
+    startup_profile = []
+    add_startup_phase(startup_profile, 'imports')
     meta = get_meta()
     check_requirements(meta)
     arguments = get_arguments()
+    add_startup_phase(startup_profile, 'arguments')
+    if arguments.daemon:
+        run_daemon(get_daemon_socket_file(), arguments.quiet)
+        sys.exit(0)
+    if arguments.startup_profile:
+        import atexit
+        atexit.register(write_startup_profile, startup_profile)
+    if arguments.timings:
+        import atexit
+        timings = start_timings()
+        atexit.register(write_timings, startup_profile, timings,
+                        arguments.timings)
+    else:
+        timings = None
 
     settings_file = get_path(arguments.settings)
     settings = get_settings(settings_file)
+    add_startup_phase(startup_profile, 'settings')
 
     if len(sys.argv) == 1:
         #print(meta['name'] + ' v' + meta['version'] + ' by ' + meta['author'])
@@ -870,10 +3237,9 @@ if __name__ == '__main__':
         for key in arguments.app:
             print(get_meta(key))
 
-    temp_dir = tempfile.TemporaryDirectory(prefix='retroplay_')
-
     retroarch_bin = settings.get('retroarch', 'bin', fallback='')
     retroarch_bin_path = get_retroarch_bin_path(retroarch_bin)
+    add_startup_phase(startup_profile, 'retroarch')
     if retroarch_bin_path is None:
         message = f'Could not find RetroArch executable: "{retroarch_bin}"'
         stderr(message, arguments.quiet)
@@ -919,7 +3285,11 @@ if __name__ == '__main__':
             'libretro_directory',
             'playlist_directory',
             'content_history_path',
-            'content_favorites_path'
+            'content_favorites_path',
+            'thumbnails_directory',
+            'content_database_path',
+            'libretro_info_path',
+            'system_directory'
         ]
     )
 
@@ -960,80 +3330,187 @@ if __name__ == '__main__':
         fullscreen = settings.get('retroarch', 'force_fullscreen',
                                   fallback=False)
 
-    playlist_file = get_playlist_file(arguments.playlist, ra_config)
-    playlist_data = get_playlist_data(playlist_file)
-    playlist_item_path = get_playlist_item(playlist_data, 'path')
+    if 'libretro_directory' in ra_config:
+        libretro_dir = get_path(ra_config['libretro_directory'])
+        core_inventory = get_core_inventory(
+                libretro_dir,
+                get_path(ra_config.get('libretro_info_path', libretro_dir)))
+    else:
+        core_inventory = None
+    filetype_matcher = get_filetype_matcher(settings, core_inventory)
+
+    add_startup_phase(startup_profile, 'config')
+
+    if arguments.playlist is not None:
+        playlist_files = get_playlist_files(arguments.playlist or ['history'],
+                                            ra_config)
+        playlist_items = get_playlists_items(playlist_files)
+        playlist_file = ', '.join(str(path) for path in playlist_files)
+    else:
+        playlist_items = []
+        playlist_file = ''
+    playlist_item_path = [path for path, _ in playlist_items]
+
+    if arguments.dir and not arguments.noindex:
+        library = get_library_index(get_path(LIBRARY_INDEX_FILE), settings,
+                                    core_inventory)
+    else:
+        library = None
 
     if arguments.dir:
-        dir_files = get_dir_files(arguments.dir)
+        if arguments.depth is not None:
+            depth = arguments.depth
+        elif arguments.recursive:
+            depth = None
+        else:
+            depth = 0
+        # Directories are only scanned once the pipeline reaches them, so
+        # a menu already shows the entries from other sources meanwhile.
+        dir_files = iter_deferred(get_dir_files, arguments.dir, library,
+                                  filetype_matcher, arguments.reindex, depth,
+                                  arguments.scan_jobs)
     else:
         dir_files = []
 
+    add_startup_phase(startup_profile, 'sources')
+
     roms_list = get_roms_list(arguments.nostdin, arguments.rom, arguments.game,
             playlist_item_path, dir_files)
+    if timings is not None:
+        roms_list = get_counted_list(roms_list, timings['entries'], 'sources')
+    if arguments.zip:
+        roms_list = get_archive_expanded_list(
+                roms_list, get_archive_index(get_path(ARCHIVE_INDEX_FILE)))
+        if timings is not None:
+            roms_list = get_counted_list(roms_list, timings['entries'], 'zip')
 
-    if roms_list:
-        if arguments.uniq:
-            roms_list = get_duplicates_removed(roms_list)
-        if arguments.filter_ext:
-            for romfilter in arguments.filter_ext:
-                roms_list = get_filtered_list_ext(roms_list, romfilter)
-        if arguments.filter_names:
-            for romfilter in arguments.filter_names:
-                roms_list = get_filtered_list_names(roms_list, romfilter)
-        if arguments.filter:
-            for romfilter in arguments.filter:
-                roms_list = get_filtered_list(roms_list, romfilter)
-        if arguments.sort_ext:
-            roms_list.sort(key=lambda path: path.suffix.lower())
-        elif arguments.sort_names:
-            roms_list.sort(key=lambda path: path.stem.lower())
-        elif arguments.sort:
-            roms_list.sort(key=lambda path: path.as_posix().lower())
-        if valid_mode:
-            roms_list = get_valid_list(roms_list, settings, valid_mode)
+    try:
+        query = get_query(arguments.filter, arguments.filter_names,
+                          arguments.filter_ext, arguments.query)
+        sort_keys = get_sort_keys(arguments)
+    except ValueError as error:
+        message = f'Invalid filter, query or sort: {error}'
+        stderr(message, arguments.quiet)
+        sys.exit(3)
 
-        if arguments.ls:
-            for path in roms_list:
-                print(path.as_posix())
+    if arguments.uniq:
+        roms_list = get_duplicates_removed(roms_list, arguments.uniq)
+        if timings is not None:
+            roms_list = get_counted_list(roms_list, timings['entries'], 'uniq')
+    if query:
+        roms_list = get_filtered_list_query(roms_list, query, settings,
+                                            filetype_matcher)
+        if timings is not None:
+            roms_list = get_counted_list(roms_list, timings['entries'],
+                                         'query')
+    if sort_keys:
+        # Only a single launch picks one entry by its position, everything
+        # else needs the whole sorted list.
+        if (arguments.index > 0 and not arguments.ls and not arguments.menu
+                and not arguments.resolve_all and not valid_mode
+                and not arguments.filter_checksum):
+            sort_limit = arguments.index
+        else:
+            sort_limit = None
+        roms_list = get_sorted_list(roms_list, sort_keys, arguments.natural,
+                                    sort_limit, settings, filetype_matcher)
+        if timings is not None:
+            roms_list = get_counted_list(roms_list, timings['entries'], 'sort')
+    if valid_mode:
+        roms_list = get_valid_list(roms_list, settings, valid_mode,
+                                   filetype_matcher, library,
+                                   arguments.validate_jobs, core_inventory)
+        if timings is not None:
+            roms_list = get_counted_list(roms_list, timings['entries'],
+                                         'validate')
+    if arguments.checksum or arguments.filter_checksum:
+        checksums = {}
+        roms_list = get_checksummed_list(
+                roms_list, checksums, arguments.checksum or 'crc32',
+                get_checksum_cache(get_path(CHECKSUM_CACHE_FILE)))
+        if arguments.filter_checksum:
+            roms_list = get_filtered_list_checksum(
+                    roms_list, checksums, arguments.filter_checksum)
+            if timings is not None:
+                roms_list = get_counted_list(roms_list, timings['entries'],
+                                             'checksum')
+        if not arguments.checksum:
+            checksums = None
+    else:
+        checksums = None
 
-        if arguments.menu == 'rofi':
-            rom_path = get_rom_byrofi(roms_list)
-        elif arguments.menu == 'dmenu':
-            rom_path = get_rom_bydmenu(roms_list)
+    if arguments.resolve_all:
+        if arguments.patch and not arguments.nopatch:
+            patch_file, patch_format = get_patch_file(arguments.patch)
         else:
-            rom_path = get_rom_byindex(roms_list, arguments.index)
-
-        if rom_path:
-            rom_path = get_path(rom_path)
-            if arguments.libretro:
-                if '/' in arguments.libretro:
-                    core_path = get_path(arguments.libretro)
-                else:
-                    core_path = get_core_path_byfilename(
-                            arguments.libretro,
-                            pathlib.Path(ra_config['libretro_directory'])
-                    )
-                core_name = ''
+            patch_file, patch_format = ('', '')
+        plans = get_launch_plans(
+                roms_list, arguments, settings, filetype_matcher,
+                pathlib.Path(ra_config['libretro_directory']), ra_config_file,
+                patch_file, patch_format, fullscreen, checksums,
+                core_inventory)
+        if not write_launch_plans(plans):
+            message = ('Could not find rom or playlist is empty:'
+                      f' "{playlist_file}"')
+            stderr(message, arguments.quiet)
+            sys.exit(1)
+        sys.exit(0)
+
+    if arguments.menu == 'tui':
+        roms_list = list(roms_list)
+        roms_count = len(roms_list)
+        if arguments.ls:
+            for path in roms_list:
+                print(get_output_line(path, checksums))
+        rom_path = get_rom_bytui(roms_list, dict(playlist_items))
+    elif arguments.menu == 'rofi':
+        rom_path, roms_count = get_rom_byrofi(roms_list, arguments.ls,
+                                              checksums)
+    elif arguments.menu == 'dmenu':
+        rom_path, roms_count = get_rom_bydmenu(roms_list, arguments.ls,
+                                               checksums)
+    else:
+        rom_path, roms_count = get_rom_byindex(roms_list, arguments.index,
+                                               arguments.ls, checksums)
+
+    prefetch = arguments.prefetch == 'on' and not arguments.norun
+    if rom_path:
+        rom_path = get_path(rom_path)
+        # Reading starts right after the selection, so RetroArch finds the
+        # files in the page cache instead of waiting for a cold disk.
+        if prefetch and rom_path:
+            start_prefetch(get_archive_path(rom_path))
+        if arguments.libretro:
+            if '/' in arguments.libretro:
+                core_path = get_path(arguments.libretro)
             else:
-                if arguments.core:
-                    core_name = arguments.core
-                else:
-                    core_name = get_core_name(settings, rom_path)
-
-                core_path = get_core_path(
-                        settings,
-                        core_name,
-                        pathlib.Path(ra_config['libretro_directory']))
-        else:
-            rom_path = ''
-            core_path = ''
+                core_path = get_core_path_byfilename(
+                        arguments.libretro,
+                        pathlib.Path(ra_config['libretro_directory']),
+                        core_inventory
+                )
             core_name = ''
+        else:
+            if arguments.core:
+                core_name = arguments.core
+            else:
+                core_name = get_core_name(settings, rom_path,
+                                          filetype_matcher)
+
+            core_path = get_core_path(
+                    settings,
+                    core_name,
+                    pathlib.Path(ra_config['libretro_directory']),
+                    core_inventory)
+        if prefetch and core_path:
+            start_prefetch(core_path)
     else:
         rom_path = ''
         core_path = ''
         core_name = ''
 
+    add_startup_phase(startup_profile, 'list')
+
     if arguments.record:
         if arguments.record_disable_macros:
             record_file = get_path(arguments.record)
@@ -1049,12 +3526,14 @@ if __name__ == '__main__':
         patch_format = ''
     elif arguments.patch:
         patch_file, patch_format = get_patch_file(arguments.patch)
-        if patch_file:
+        if patch_file and arguments.softpatch:
+            import tempfile
+            temp_dir = tempfile.TemporaryDirectory(prefix='retroplay_')
             real_rom_path = rom_path
             link_name = patch_file.name + '_' + rom_path.name
             rom_path = pathlib.Path(temp_dir.name + '/' + link_name)
             rom_path.symlink_to(real_rom_path)
-        else:
+        elif not patch_file:
             patch_file = ''
             patch_format = ''
             link_name = ''
@@ -1062,15 +3541,15 @@ if __name__ == '__main__':
         patch_file = ''
         patch_format = ''
 
-    if arguments.ls and not roms_list:
+    if arguments.ls and not roms_count:
         message = f'Could not find rom or playlist is empty: "{playlist_file}"'
         stderr(message, arguments.quiet)
         sys.exit(1)
-    elif not rom_path or not rom_path.exists():
+    elif not rom_path or not get_archive_path(rom_path).exists():
         message = f'Could not find rom: "{rom_path}"'
         stderr(message, arguments.quiet)
         sys.exit(1)
-    elif not get_mimetype(rom_path) == 'binary':
+    elif not get_mimetype(get_archive_path(rom_path)) == 'binary':
         message = f'Path to rom file is not in a binary format: "{rom_path}"'
         stderr(message, arguments.quiet)
         sys.exit(1)
@@ -1092,6 +3571,21 @@ if __name__ == '__main__':
         stderr(message, arguments.quiet)
         sys.exit(3)
 
+    if patch_file and not arguments.softpatch:
+        try:
+            rom_path = get_patched_rom(rom_path, patch_file, patch_format,
+                                       get_path(PATCH_CACHE_DIR),
+                                       arguments.patch_cache_size * 1024 * 1024)
+        except (OSError, ValueError) as error:
+            message = f'Could not apply patch: "{patch_file}" ({error})'
+            stderr(message, arguments.quiet)
+            sys.exit(3)
+        # The ROM is patched already, RetroArch must not do it again.
+        patch_file = ''
+        patch_format = ''
+
+    add_startup_phase(startup_profile, 'checks')
+
     command = get_command(retroarch_bin_path,
                           arguments,
                           core_path,
@@ -1103,18 +3597,30 @@ if __name__ == '__main__':
                           fullscreen
     )
     if not arguments.norun:
-        try:
-            completed_process = subprocess.run(command,
-                    capture_output=True,
-                    check=True)
-            #stderr(completed_process, arguments.quiet)
-            if completed_process.returncode == 0:
-                if arguments.what:
-                    print(rom_path.as_posix())
-                if arguments.which:
-                    print(core_path.as_posix())
-        except subprocess.CalledProcessError:
-            pass
+        # Nothing must happen after RetroArch exits, and a temporary
+        # directory from "--softpatch" would never be removed.
+        if (arguments.exec and not arguments.what and not arguments.which
+                and not arguments.log and not arguments.timings
+                and not arguments.startup_profile
+                and not (patch_file and arguments.softpatch)):
+            sys.stdout.flush()
+            sys.stderr.flush()
+            try:
+                os.execvp(command[0], command)
+            except OSError:
+                pass
+        returncode, output = run_retroarch(
+                command, get_path(arguments.log) if arguments.log else None)
+        if returncode == 0:
+            if arguments.what:
+                print(rom_path.as_posix())
+            if arguments.which:
+                print(core_path.as_posix())
+        else:
+            message = f'RetroArch exited with status {returncode}'
+            if output:
+                message += ', last output:\n' + '\n'.join(output)
+            stderr(message, arguments.quiet)
     else:
         if arguments.what:
             print(rom_path.as_posix())
@@ -1123,3 +3629,16 @@ if __name__ == '__main__':
 
     sys.exit(0)
 
+
+if __name__ == '__main__':
+    if '--client' in sys.argv[1:]:
+        arguments = get_silent_arguments(sys.argv[1:])
+    else:
+        arguments = None
+    # The terminal menu needs the controlling terminal of this process.
+    if (arguments is not None and arguments.client and not arguments.daemon
+            and arguments.menu != 'tui'):
+        status = run_client(get_daemon_socket_file(), sys.argv[1:])
+        if status is not None:
+            sys.exit(status)
+    main()